@@ -1,11 +1,15 @@
 from __future__ import absolute_import
 
+import functools
+import hashlib
 import logging
 import os
 import re
 import urllib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+import ijson
 import requests
 from ckan import model
 from ckan.lib.helpers import json
@@ -15,38 +19,98 @@ from ckan.plugins import toolkit
 from ckanext.datapress_harvester.util import (
     add_default_extras,
     add_existing_extras,
-    get_harvested_dataset_ids,
+    get_ids_to_delete,
+    get_package_extra_val,
+    json_dumps,
+    json_loads,
+    package_extra,
+    save_harvest_objects,
+    upsert_package_extra,
 )
 from ckanext.harvest.harvesters import HarvesterBase
-from .mixins import DFLHarvesterMixin
+from .mixins import DFLHarvesterMixin, get_provider_org_mappings_digest
 from ckanext.harvest.model import HarvestObject
 log = logging.getLogger(__name__)
 
 EXTRA_PKG_FIELDS = ['london_smallest_geography', 'update_frequency']
 EXTRA_RESOURCE_FIELDS = ['temporal_coverage_from', 'temporal_coverage_to']
+# Keys of a remote group dict that aren't passed on to group_create
+GROUP_DROP_KEYS = (
+    "packages",
+    "created",
+    "users",
+    "groups",
+    "tags",
+    "extras",
+    "display_name",
+)
+TAG_INVALID_CHARS_RE = re.compile(r"[^a-zA-Z0-9 \-_.]")
+TAG_VALID_RE = re.compile(r"[a-zA-Z0-9 \-_.]*")
+# Emails made up only of these characters are left unchanged by
+# quote(email, safe="@"), so they don't need quoting
+EMAIL_UNQUOTED_RE = re.compile(r"[A-Za-z0-9_.\-~@]*")
+# Deletes the ASCII characters TAG_INVALID_CHARS_RE matches, for use with
+# str.translate, which is much quicker than a regex substitution
+TAG_INVALID_ASCII_CHARS = str.maketrans(
+    "", "", "".join(c for c in map(chr, range(128)) if TAG_INVALID_CHARS_RE.match(c))
+)
+# Seconds to wait to connect to the remote DataPress, and between bytes of its
+# responses, so a stalled server can't hang the harvest indefinitely
+REQUEST_TIMEOUT = 60
+# Part of each dataset's upstream_content_hash. Bump it whenever the way
+# datasets are transformed on import changes, so that datasets imported
+# before the change are updated rather than skipped as unchanged
+CONTENT_HASH_VERSION = "1"
+AIRDRIVE_PREFIX = "https://airdrive-secure.s3-eu-west-1"
+LONDON_DOWNLOAD_URL = "https://data.london.gov.uk/download/{dataset}/{id}/{file}.{format}"
+DEFAULT_PKG_KEYS = (
+    "author",
+    "author_email",
+    "license_id",
+    "license_title",
+    "url",
+    "version",
+)
 
-def normalise_ckan_resources(package_dict):
-    normalised_resources = package_dict.get('resources',[])
-    if not package_dict.get('resources') and package_dict.get('organization',{}).get('resources',[]):
-        # The brent/barnet datapress instances return resources under
-        # organization/resources not /resources like london data-press.
-        #
-        # So we harmonise them here
-        normalised_resources = package_dict.get('organization',{}).get('resources',[])
 
-    def fixup_id(res):
-        input_id = res['id']
+def _remove_nones(d):
+    """Remove the keys whose value is None from d, in place"""
+    without_nones = {k: v for k, v in d.items() if v is not None}
+    if len(without_nones) != len(d):
+        d.clear()
+        d.update(without_nones)
+
+
+def normalise_ckan_resources(package_dict):
+    # The brent/barnet datapress instances return resources under
+    # organization/resources not /resources like london data-press.
+    #
+    # So we harmonise them here
+    resources = package_dict.get('resources') or (
+        package_dict.get('organization') or {}
+    ).get('resources', [])
+
+    for res in resources:
         # CKAN has a validation that ID's must have a minimum length,
         # but upstream sources have different rules, so pad ids with
         # 0's if they're shorter than 7 characters
-        res['id'] = input_id.rjust(7,'0')
-        
-        return res
+        if len(res['id']) < 7:
+            res['id'] = res['id'].rjust(7, '0')
+
+        # Clear remote url_type for resources (eg datastore, upload) as
+        # we are only creating normal resources with links to the
+        # remote ones
+        if "url_type" in res:
+            del res["url_type"]
+
+        # Clear revision_id as the revision won't exist on this CKAN
+        # and saving it will cause an IntegrityError with the foreign
+        # key.
+        if "revision_id" in res:
+            del res["revision_id"]
+
+    package_dict['resources'] = resources
 
-    normalised_resources = list(map(fixup_id, normalised_resources))
-    package_dict['resources'] = normalised_resources
-    
-    
 
 class DataPressHarvester(HarvesterBase, DFLHarvesterMixin):
     """
@@ -61,10 +125,17 @@ class DataPressHarvester(HarvesterBase, DFLHarvesterMixin):
     """
 
     config = None
+    _config_str = None
 
     def _set_config(self, config_str):
+        # Every object in a harvest job has the same config, so only parse it
+        # (and log it) when it's different from the last one
+        if self.config is not None and config_str == self._config_str:
+            return
+        self._config_str = config_str
+
         if config_str:
-            self.config = json.loads(config_str)
+            self.config = json_loads(config_str)
             if "api_version" in self.config:
                 self.api_version = int(self.config["api_version"])
 
@@ -85,7 +156,7 @@ class DataPressHarvester(HarvesterBase, DFLHarvesterMixin):
             return config
 
         try:
-            config_obj = json.loads(config)
+            config_obj = json_loads(config)
 
             if "api_version" in config_obj:
                 try:
@@ -116,18 +187,31 @@ class DataPressHarvester(HarvesterBase, DFLHarvesterMixin):
 
                 # Check if default groups exist
                 context = {"model": model, "user": toolkit.c.user}
+                # Only look up each group once, even if it's listed twice
+                default_groups = list(dict.fromkeys(config_obj["default_groups"]))
+                # Fetch the groups given by name in a single group_list call,
+                # then fall back to group_show for any that it didn't return
+                # (e.g. groups given by id)
+                found_groups = {}
+                for group in get_action("group_list")(
+                    context.copy(), {"groups": default_groups, "all_fields": True}
+                ):
+                    found_groups[group["name"]] = group
+                    found_groups[group["id"]] = group
                 config_obj["default_group_dicts"] = []
-                for group_name_or_id in config_obj["default_groups"]:
-                    try:
-                        group = get_action("group_show")(
-                            context, {"id": group_name_or_id}
-                        )
-                        # save the dict to the config object, as we'll need it
-                        # in the import_stage of every dataset
-                        config_obj["default_group_dicts"].append(group)
-                    except NotFound:
-                        raise ValueError("Default group not found")
-                config = json.dumps(config_obj)
+                for group_name_or_id in default_groups:
+                    group = found_groups.get(group_name_or_id)
+                    if group is None:
+                        try:
+                            group = get_action("group_show")(
+                                context.copy(), {"id": group_name_or_id}
+                            )
+                        except NotFound:
+                            raise ValueError("Default group not found")
+                    # save the dict to the config object, as we'll need it
+                    # in the import_stage of every dataset
+                    config_obj["default_group_dicts"].append(group)
+                config = json_dumps(config_obj)
 
             if "default_extras" in config_obj:
                 if not isinstance(config_obj["default_extras"], dict):
@@ -176,25 +260,26 @@ class DataPressHarvester(HarvesterBase, DFLHarvesterMixin):
 
         return config
 
-    def modify_package_dict(self, package_dict, harvest_object):
+    def modify_package_dict(self, package_dict, harvest_object, unprocessed_dataset_dict=None):
         """
         Allows custom harvesters to modify the package dict before
         creating or updating the actual package.
+
+        unprocessed_dataset_dict is the parsed harvest object content; it is
+        parsed from harvest_object if the caller hasn't already done so.
         """
-        unprocessed_dataset_dict = json.loads(harvest_object.content)
+        if unprocessed_dataset_dict is None:
+            unprocessed_dataset_dict = json_loads(harvest_object.content)
 
+        extras = package_dict["extras"]
         for field in EXTRA_PKG_FIELDS:
             if unprocessed_dataset_dict.get(field):
-                package_dict["extras"] += [
-                    {
-                        "key": field,
-                        "value": unprocessed_dataset_dict[field],
-                    }
-                ]
+                extras.append(package_extra(field, unprocessed_dataset_dict[field]))
 
         # Update modified date so package is updated in database
         # (see _create_or_update_package() in harvester plugin)
-        package_dict["metadata_modified"] = strip_time_zone(datetime.now().isoformat())
+        # (datetime.now() is naive, so there's no time zone to strip)
+        package_dict["metadata_modified"] = datetime.now().isoformat()
 
         return package_dict
 
@@ -205,7 +290,8 @@ class DataPressHarvester(HarvesterBase, DFLHarvesterMixin):
         the recommended method.
         """
         url_route = f'{remote_datapress_base_url}/api/whoami'
-        json_response = requests.get(url_route,headers={'Authorization': self.config['datapress_api_key'] }).json()
+        response = self.http_session.get(url_route,headers={'Authorization': self.config['datapress_api_key'] }, timeout=REQUEST_TIMEOUT)
+        json_response = json_loads(response.content)
         jwt_token = json_response['readonly']['libraryJwt']
         # log.debug(f'JWT token: {jwt_token}')
         return jwt_token
@@ -230,6 +316,11 @@ class DataPressHarvester(HarvesterBase, DFLHarvesterMixin):
         # but we can't because the DataPress package_search endpoint doesn't
         # support the filter query parameter. The full blob of metadata isn't
         # too large so this turns out not to be a big deal.
+        #
+        # A delta harvest would also need a second way to find out which
+        # datasets have been deleted upstream: at the moment that's every
+        # local dataset missing from the full list, and unchanged datasets are
+        # cheaply skipped in import_stage via their upstream_content_hash.
         try:
             pkg_dicts = self._fetch_packages(remote_datapress_base_url)
         except ContentFetchError as e:
@@ -248,37 +339,25 @@ class DataPressHarvester(HarvesterBase, DFLHarvesterMixin):
             )
             return []
 
-        # Create a Set of dataset ids fetched from upstream,
-        # for comparing with those that have been harvested previously and are already in the database
-        fetched_ids = {p["id"] for p in pkg_dicts}
+        if self.config.get("remote_groups") == "create":
+            self._attach_remote_groups(remote_datapress_base_url, pkg_dicts)
 
-        # Get the Set of ids of datasets in the database that belong to this harvest source
-        existing_dataset_ids = get_harvested_dataset_ids(harvest_job.source.id)
-
-        # Datasets that are present locally but not upstream need to be deleted locally
-        to_be_deleted = existing_dataset_ids - fetched_ids
-        log.info(f"{len(to_be_deleted)} datasets need to be deleted")
+        self._attach_image_formats(pkg_dicts)
 
         # Create harvest objects for each dataset
         try:
             package_ids = set()
-            object_ids = []
+            harvest_objects = []
 
             for pkg_dict in pkg_dicts:
-                if pkg_dict["private"] and not self.config.get('harvest_private_datasets'):
-                    log.info('Discarding private dataset %s %s', {pkg_dict["name"]}, {pkg_dict["id"]})
-                    continue
-
-                if pkg_dict["id"] in package_ids:
-                    log.info(
-                        "Discarding duplicate dataset %s - probably due "
-                        "to datasets being changed at the same time as "
-                        "when the harvester was paging through",
-                        pkg_dict["id"],
-                    )
-                    continue
                 package_ids.add(pkg_dict["id"])
 
+                # import_stage drops None values anyway, so don't store them in
+                # the harvest object only to parse them again
+                _remove_nones(pkg_dict)
+                for resource in pkg_dict.get("resources") or []:
+                    _remove_nones(resource)
+
                 # Add a field signifying that this is a create/update to a dataset, rather than one that needs deleting.
                 # Not currently used for anything.
                 pkg_dict["action"] = "upsert"
@@ -286,11 +365,16 @@ class DataPressHarvester(HarvesterBase, DFLHarvesterMixin):
                 log.debug(
                     "Creating HarvestObject for %s %s", pkg_dict["name"], pkg_dict["id"]
                 )
-                obj = HarvestObject(
-                    guid=pkg_dict["id"], job=harvest_job, content=json.dumps(pkg_dict)
+                harvest_objects.append(
+                    HarvestObject(
+                        guid=pkg_dict["id"], job=harvest_job, content=json_dumps(pkg_dict)
+                    )
                 )
-                obj.save()
-                object_ids.append(obj.id)
+
+            # Datasets in the database that belong to this harvest source but are
+            # not (or no longer publicly) present upstream need to be deleted locally
+            to_be_deleted = get_ids_to_delete(harvest_job.source.id, package_ids)
+            log.info(f"{len(to_be_deleted)} datasets need to be deleted")
 
             # Create jobs to purge the datasets that no longer exist upstream.
             # Needs to be 'purge' instead of 'delete' so that the dataset can be re-harvested
@@ -298,75 +382,199 @@ class DataPressHarvester(HarvesterBase, DFLHarvesterMixin):
             for i in to_be_deleted:
                 # the dataset_purge function in the import_stage only needs the dataset ID to be able to purge the dataset.
                 pkg_dict = {"id": i, "action": "delete"}
-                obj = HarvestObject(
-                    guid=i, job=harvest_job, content=json.dumps(pkg_dict)
+                harvest_objects.append(
+                    HarvestObject(guid=i, job=harvest_job, content=json_dumps(pkg_dict))
                 )
-                obj.save()
-                object_ids.append(obj.id)
 
-            return object_ids
+            return save_harvest_objects(harvest_objects)
         except Exception as e:
             log.exception("Exception during gather_stage")
-            self._save_gather_error("%r" % e.message, harvest_job)
+            self._save_gather_error("%r" % e, harvest_job)
+
+    def _get_group(self, remote_datapress_base_url, group_):
+        """Fetch a group's dict from the remote DataPress instance"""
+        url = f"{remote_datapress_base_url.rstrip('/')}/api/action/group_show"
+        try:
+            response = self.http_session.get(
+                url, params={"id": _group_key(group_)}, timeout=REQUEST_TIMEOUT
+            )
+            response.raise_for_status()
+            return json_loads(response.content)["result"]
+        except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+            raise RemoteResourceError(f"Could not fetch remote group {group_}: {e}")
+
+    def _attach_remote_groups(self, remote_datapress_base_url, pkg_dicts):
+        """
+        Fetch every remote group referenced by pkg_dicts and attach the group
+        dicts to the packages as "remote_group_dicts", so that import_stage
+        doesn't have to request the same groups over and over again.
+
+        Groups that already exist locally are skipped, as are the parts of the
+        group dicts that group_create doesn't need. The rest are requested
+        concurrently. Any that can't be fetched are left out, and import_stage
+        falls back to requesting them itself.
+        """
+        local_groups = set()
+        query = model.Session.query(model.Group.id, model.Group.name).filter(
+            model.Group.state == "active",
+            model.Group.is_organization == False,  # noqa: E712
+        )
+        for group_id, group_name in query:
+            local_groups.update((group_id, group_name))
+
+        group_keys = {
+            _group_key(group_)
+            for pkg_dict in pkg_dicts
+            for group_ in pkg_dict.get("groups") or []
+            if _group_key(group_)
+            and group_.get("id") not in local_groups
+            and group_.get("name") not in local_groups
+        }
+
+        def fetch(key):
+            try:
+                return key, self._get_group(remote_datapress_base_url, {"id": key})
+            except RemoteResourceError:
+                log.warning("Could not prefetch remote group %s", key)
+                return key, None
+
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            remote_groups = {
+                key: {k: v for k, v in group.items() if k not in GROUP_DROP_KEYS}
+                for key, group in executor.map(fetch, group_keys)
+                if group
+            }
+
+        for pkg_dict in pkg_dicts:
+            pkg_dict["remote_group_dicts"] = {
+                _group_key(group_): remote_groups[_group_key(group_)]
+                for group_ in pkg_dict.get("groups") or []
+                if _group_key(group_) in remote_groups
+            }
+
+    def _attach_image_formats(self, pkg_dicts):
+        """
+        Work out the format of every "image" resource in pkg_dicts and attach
+        them to the packages as "image_formats" ({url: format}), so that
+        import_stage doesn't have to make a request for each one.
+
+        The urls are requested concurrently. Resources whose url can't be
+        worked out here are left for import_stage to request itself.
+        """
+        image_urls = {}
+        for pkg_dict in pkg_dicts:
+            urls = set()
+            for resource in pkg_dict.get("resources") or []:
+                if resource.get("format") != "image" or not resource.get("url"):
+                    continue
+                try:
+                    urls.add(_resource_url(pkg_dict, resource))
+                except (KeyError, TypeError):
+                    # e.g. an airdrive resource with no name
+                    continue
+            if urls:
+                image_urls[pkg_dict["id"]] = urls
+
+        if not image_urls:
+            return
+
+        all_urls = set().union(*image_urls.values())
+        log.info("Requesting the formats of %d images", len(all_urls))
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            formats = dict(
+                zip(all_urls, executor.map(self._request_image_format, all_urls))
+            )
+
+        for pkg_dict in pkg_dicts:
+            urls = image_urls.get(pkg_dict["id"])
+            if urls:
+                pkg_dict["image_formats"] = {url: formats[url] for url in urls}
 
     def _fetch_datapress_extra_fields(self, remote_datapress_base_url, request_headers):
         """
         Get extra fields from DataPress API that aren't present in the datapress package list (see _fetch_packages())
         """
         url = f"{remote_datapress_base_url}/api/datasets/export.json"
-        response = requests.get(url, headers=request_headers)
-        response.raise_for_status()
-        response_dict = response.json()
+        with self.http_session.get(
+            url, headers=request_headers, stream=True, timeout=REQUEST_TIMEOUT
+        ) as response:
+            response.raise_for_status()
+            # The export covers every dataset on the instance, so parse it
+            # incrementally rather than holding the whole document in memory.
+            response.raw.decode_content = True
+            return self._extra_fields_lookup(
+                ijson.items(response.raw, "item", use_float=True)
+            )
 
+    def _extra_fields_lookup(self, export_packages):
+        """
+        Build a lookup of package id -> extra fields from an iterable of
+        packages from the DataPress export API.
+        """
         lookup = {}
 
         def has_value(v):
-            return v != None or v != ''
-
-        for package_dict in response_dict:
-            pkg_id = package_dict['id']
-            pkg_extra_fields = {}
-            for field in EXTRA_PKG_FIELDS:
-                if field in package_dict and has_value(package_dict[field]):
-                    pkg_extra_fields[field] = package_dict[field]
-                    lookup[pkg_id] = pkg_extra_fields
+            return v is not None and v != ''
+
+        for package_dict in export_packages:
+            pkg_extra_fields = {
+                field: package_dict[field]
+                for field in EXTRA_PKG_FIELDS
+                if field in package_dict and has_value(package_dict[field])
+            }
+
+            resources = package_dict.get('resources') or {}
+            if isinstance(resources, list):
+                # NOTE: the barnet/brent datapress instances on the
+                # export API return a structure like:
+                #
+                # resources: [<res_obj>]
+                #
+                # Where as the data for london datapress returns:
+                # resources: {<res_id>: <res_obj>}
+                #
+                # So we normalise these to the london datapress format.
+                resources = {res_obj['id']: res_obj for res_obj in resources}
 
             resources_extras = {}
+            for res_id, res_obj in resources.items():
+                resource_extra_fields = {
+                    field: res_obj[field]
+                    for field in EXTRA_RESOURCE_FIELDS
+                    if field in res_obj and has_value(res_obj[field])
+                }
+                if resource_extra_fields:
+                    resources_extras[res_id] = resource_extra_fields
+            if resources_extras:
+                pkg_extra_fields['resources'] = resources_extras
+
+            # Only keep the extra fields, not the rest of the export, and
+            # only for packages that have some
+            if pkg_extra_fields:
+                lookup[package_dict['id']] = pkg_extra_fields
 
-            if isinstance(package_dict.get('resources'), list):
-               # NOTE: the barnet/brent datapress instances on the
-               # export API return a structure like:
-               #
-               # resources: [<res_obj>]
-               #
-               # Where as the data for london datapress returns:
-               # resources: {<res_id>: <res_obj>}
-               #
-               # So we normalise these to the london datapress format.
-
-               normalised_resources = []
-               for res_obj in package_dict.get('resources',[]):
-                   res_id = res_obj['id']
-                   
-                   normalised_resources.append({res_id: res_obj})
-               package_dict['resources'] = normalised_resources
-
-            
-            if isinstance(package_dict.get('resources'), dict):
-               for res_id, res_obj in package_dict.get('resources',[]).items():                   
-                   resource_extra_fields = {}
-                   for field in EXTRA_RESOURCE_FIELDS:
-                       if field in res_obj and has_value(res_obj[field]):
-                           resource_extra_fields[field] = res_obj[field]
-                   if resource_extra_fields:
-                       resources_extras[res_id] = resource_extra_fields
-               package_dict['resources'] = resources_extras
-               lookup[pkg_id] = package_dict
-        
         return lookup
 
+    def _iter_packages(self, url, request_headers):
+        """
+        Yield the package dicts from DataPress's CKAN compatibility API one
+        at a time, as they are parsed from the response
+        """
+        with self.http_session.get(
+            url, headers=request_headers, stream=True, timeout=REQUEST_TIMEOUT
+        ) as response:
+            # A failed CKAN action call comes back with an error status (and
+            # "success": false), so there's no need to read the whole
+            # document to check it
+            response.raise_for_status()
+            response.raw.decode_content = True
+            yield from ijson.items(response.raw, "result.item", use_float=True)
+
     def _fetch_packages(self, remote_datapress_base_url):
-        """Fetch the current package list from DataPress"""
+        """
+        Fetch the current package list from DataPress, without the private
+        (unless harvest_private_datasets is set) and duplicate datasets
+        """
 
         if self.config.get('datapress_api_key'):
             # NOTE: Data press uses a non-standard 'Identity' HTTP
@@ -386,18 +594,42 @@ class DataPressHarvester(HarvesterBase, DFLHarvesterMixin):
         # https://datapress.gitbook.io/datapress/ckan-requests
         url = f"{remote_datapress_base_url}/api/action/current_package_list_with_resources"
         log.info("Fetching DataPress datasets: %s", url)
-        data = requests.get(url, headers=request_headers).json()
 
-        assert data["success"]
+        # The package list and the export of extra fields (which aren't
+        # present in the datapress package list) don't depend on each other,
+        # so request them concurrently rather than paying for two round trips.
+        #
+        # The package list is filtered as it's parsed, so the datasets we won't
+        # harvest are dropped straight away rather than held on to.
+        harvest_private_datasets = self.config.get('harvest_private_datasets')
+        package_ids = set()
+        pkg_dicts = []
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            extra_fields_future = executor.submit(
+                self._fetch_datapress_extra_fields,
+                remote_datapress_base_url,
+                request_headers,
+            )
 
-        results = data["result"]
+            for dataset_dict in self._iter_packages(url, request_headers):
+                if dataset_dict["private"] and not harvest_private_datasets:
+                    log.info('Discarding private dataset %s %s', dataset_dict["name"], dataset_dict["id"])
+                    continue
 
-        # Get extra fields from DataPress API that aren't present in the datapress package list
-        self.extra_fields_lookup = self._fetch_datapress_extra_fields(
-            remote_datapress_base_url, request_headers
-        )
+                if dataset_dict["id"] in package_ids:
+                    log.info(
+                        "Discarding duplicate dataset %s - probably due "
+                        "to datasets being changed at the same time as "
+                        "when the harvester was paging through",
+                        dataset_dict["id"],
+                    )
+                    continue
+                package_ids.add(dataset_dict["id"])
+                pkg_dicts.append(dataset_dict)
 
-        for dataset_dict in results:
+            self.extra_fields_lookup = extra_fields_future.result()
+
+        for dataset_dict in pkg_dicts:
             extra_fields = self.extra_fields_lookup.get(dataset_dict["id"], {})
             extra_resource_fields = extra_fields.pop('resources',[])
             for resource_obj in dataset_dict.get('resources',[]):
@@ -406,8 +638,8 @@ class DataPressHarvester(HarvesterBase, DFLHarvesterMixin):
                     resource_obj.update(extra_resource_fields[res_id])
 
             dataset_dict.update(extra_fields)
-        
-        return results
+
+        return pkg_dicts
 
     def fetch_stage(self, harvest_object):
         # Nothing to do here - we got the package dict in the search in the
@@ -421,16 +653,50 @@ class DataPressHarvester(HarvesterBase, DFLHarvesterMixin):
         except Exception as e:
             return "data"
 
-    def _guess_image_format(self, url):
+    def _guess_image_format(self, url, harvest_object):
+        # Many resources share the same image, so remember what we found
+        # for each url for the rest of the harvest job
+        formats = self._get_job_cache(harvest_object).setdefault("image_formats", {})
+        if url not in formats:
+            formats[url] = self._request_image_format(url)
+        return formats[url]
+
+    def _request_image_format(self, url):
         try:
-            # Get the response headers from the image url
+            # Only the headers are needed, so try a HEAD request first and
+            # fall back to a GET for servers that don't handle HEAD properly
             # (stream=True does not download the response body immediately)
-            r = requests.get(url, stream=True)
+            r = self.http_session.head(url, allow_redirects=True, timeout=5)
+            if r.status_code != 200:
+                # Close the response so the connection goes back to the pool
+                with self.http_session.get(url, stream=True, timeout=5) as r:
+                    return r.headers["Content-Type"].split("/")[1]
             content_type = r.headers["Content-Type"]
             return content_type.split("/")[1]
         except Exception as e:
             return "image"
 
+    def _get_package_state(self, pkg_id):
+        """The state of the local package pkg_id, or None if there isn't one"""
+        return (
+            model.Session.query(model.Package.state)
+            .filter(model.Package.id == pkg_id)
+            .scalar()
+        )
+
+    def _show_group(self, base_context, harvest_object, group_name_or_id):
+        """
+        group_show, memoised for the rest of the harvest job since most
+        datasets share the same handful of groups. Groups that aren't found
+        aren't cached, as they may be created later in the job.
+        """
+        groups = self._get_local_groups(harvest_object, is_organization=False)
+        if group_name_or_id not in groups:
+            groups[group_name_or_id] = get_action("group_show")(
+                base_context.copy(), {"id": group_name_or_id}
+            )
+        return groups[group_name_or_id]
+
     def _datapress_to_ckan(self, package_dict, harvest_object):
         """
         Shims to transform DataPress packages into a format CKAN understands.
@@ -438,29 +704,29 @@ class DataPressHarvester(HarvesterBase, DFLHarvesterMixin):
         Long term we might want some of these transformations to be errors
         instead, and seek changes to the upstream metadata.
         """
-        # Remove Nones
-        for key in list(package_dict):
-            if package_dict[key] is None:
-                del package_dict[key]
+        _remove_nones(package_dict)
 
         def fixup_tag(tag):
-            new_tag = re.sub("[^a-zA-Z0-9 \-_.]", "", tag)
-            return {'name': new_tag}
+            # Most tags are already valid, so only substitute when needed
+            if not TAG_VALID_RE.fullmatch(tag):
+                if tag.isascii():
+                    tag = tag.translate(TAG_INVALID_ASCII_CHARS)
+                else:
+                    tag = TAG_INVALID_CHARS_RE.sub("", tag)
+            return {'name': tag}
 
         if package_dict.get('tags'):
-            package_dict["tags"] = list(map(fixup_tag, package_dict["tags"]))
+            package_dict["tags"] = [fixup_tag(tag) for tag in package_dict["tags"]]
 
         # Some emails need cleaning up. (I think CKAN is actually too strict
         # here, and rejects valid emails. You're allowed some pretty weird
         # characters in an email address!)
-        if "author_email" in package_dict:
-            package_dict["author_email"] = urllib.parse.quote(
-                package_dict["author_email"].strip(), safe="@"
-            )
-        if "maintainer_email" in package_dict:
-            package_dict["maintainer_email"] = urllib.parse.quote(
-                package_dict["maintainer_email"].strip(), safe="@"
-            )
+        for key in ("author_email", "maintainer_email"):
+            if key in package_dict:
+                email = package_dict[key].strip()
+                if not EMAIL_UNQUOTED_RE.fullmatch(email):
+                    email = quote(email, safe="@")
+                package_dict[key] = email
 
         if "organization" in package_dict:
             organization = package_dict["organization"]
@@ -473,48 +739,28 @@ class DataPressHarvester(HarvesterBase, DFLHarvesterMixin):
                 organization["name"] = organization["id"]
 
         # CKAN expects these things to be empty strings rather than None
-        default_keys = [
-            "author",
-            "author_email",
-            "license_id",
-            "license_title",
-            "url",
-            "version",
-        ]
-        for key in default_keys:
-            if key not in package_dict:
-                package_dict[key] = ""
+        package_dict.update(
+            {key: "" for key in DEFAULT_PKG_KEYS if key not in package_dict}
+        )
 
         for resource in package_dict.get("resources",[]):
-            # Remove Nones
-            for key in list(resource):
-                if resource[key] is None:
-                    del resource[key]
+            _remove_nones(resource)
 
             if "created" in resource:
                 # Datapress exposes a datetime like YYYY-MM-DDTHH:MM:SS... but
                 # we only want the date portion
                 resource["created"] = resource["created"][:10]
 
-            # these URLs are forbidden, so we need to reconstruct the
-            # data.london.gov URLs
-            # TODO this is specific to data.london.gov.uk, we need a way to make
-            # tweaks like this on a per-datapress-instance basis.
-            # Do all DataPress instances work similarly? Can we use the harvest
-            # URL here?
-            if resource["url"].startswith("https://airdrive-secure.s3-eu-west-1"):
-                base = "https://data.london.gov.uk/download"
-                dataset = package_dict["name"]
-                id = resource["id"]
-                file = urllib.parse.quote(resource["name"])
-                format = resource["format"]
-                resource["url"] = f"{base}/{dataset}/{id}/{file}.{format}"
+            # Rewrite forbidden airdrive URLs (see _resource_url)
+            resource["url"] = _resource_url(package_dict, resource)
 
             if "format" not in resource or not resource["format"]:
                 resource["format"] = self._resource_format_from_url(resource["url"])
 
             if resource["format"] == "image":
-                resource["format"] = self._guess_image_format(resource["url"])
+                resource["format"] = self._guess_image_format(
+                    resource["url"], harvest_object
+                )
 
         # Remove the timezone from the dates. CKAN doesn't store it internally and it
         # messes up date-based comparisons later if the timezone is kept (because the base
@@ -558,7 +804,12 @@ class DataPressHarvester(HarvesterBase, DFLHarvesterMixin):
         self._set_config(harvest_object.job.source.config)
 
         try:
-            package_dict = json.loads(harvest_object.content)
+            package_dict = json_loads(harvest_object.content)
+            remote_group_dicts = package_dict.pop("remote_group_dicts", {})
+            # Image formats found during the gather stage
+            self._get_job_cache(harvest_object).setdefault("image_formats", {}).update(
+                package_dict.pop("image_formats", {})
+            )
 
             # Delete the dataset if its "action" is "delete"
             if package_dict["action"] == "delete":
@@ -568,19 +819,47 @@ class DataPressHarvester(HarvesterBase, DFLHarvesterMixin):
                 )
                 return True
 
+            # Hash a canonical form of the upstream dataset, along with
+            # everything else that decides how it's imported (the harvest
+            # source config, the organisation mappings and the version of the
+            # transformation), so that unchanged datasets can be skipped below.
+            # The key order of the raw content isn't stable between gathers,
+            # so it can't be hashed as-is
+            content_hash = hashlib.sha256(
+                (
+                    CONTENT_HASH_VERSION
+                    + get_provider_org_mappings_digest()
+                    + json.dumps(package_dict, sort_keys=True, separators=(",", ":"))
+                    + (harvest_object.job.source.config or "")
+                ).encode()
+            ).hexdigest()
+
             package_dict = self._datapress_to_ckan(package_dict, harvest_object)
 
             if package_dict.get("type") == "harvest":
                 log.warn("Remote dataset is a harvest source, ignoring...")
                 return True
 
+            source_url = harvest_object.job.source.url.rstrip("/")
+            pkg_id = package_dict["id"]
+            ho_id = harvest_object.id
+            # _datapress_to_ckan has already stripped the time zones from these
+            metadata_modified = package_dict["metadata_modified"]
+            metadata_created = package_dict["metadata_created"]
+
             # Set default tags if needed
             default_tags = self.config.get("default_tags", [])
             if default_tags:
                 if "tags" not in package_dict:
                     package_dict["tags"] = []
+                existing_tag_names = {t["name"] for t in package_dict["tags"]}
+                # Copy the tags, as the parsed config is reused between datasets
                 package_dict["tags"].extend(
-                    [t for t in default_tags if t not in package_dict["tags"]]
+                    [
+                        dict(t)
+                        for t in default_tags
+                        if t["name"] not in existing_tag_names
+                    ]
                 )
 
             remote_groups = self.config.get("remote_groups", None)
@@ -598,18 +877,16 @@ class DataPressHarvester(HarvesterBase, DFLHarvesterMixin):
                     try:
                         try:
                             if "id" in group_:
-                                data_dict = {"id": group_["id"]}
-                                group = get_action("group_show")(
-                                    base_context.copy(), data_dict
+                                group = self._show_group(
+                                    base_context, harvest_object, group_["id"]
                                 )
                             else:
                                 raise NotFound
 
                         except NotFound:
                             if "name" in group_:
-                                data_dict = {"id": group_["name"]}
-                                group = get_action("group_show")(
-                                    base_context.copy(), data_dict
+                                group = self._show_group(
+                                    base_context, harvest_object, group_["name"]
                                 )
                             else:
                                 raise NotFound
@@ -622,22 +899,14 @@ class DataPressHarvester(HarvesterBase, DFLHarvesterMixin):
                         log.info("Group %s is not available", group_)
                         if remote_groups == "create":
                             try:
-                                group = self._get_group(
-                                    harvest_object.source.url, group_
-                                )
+                                group = remote_group_dicts.get(
+                                    _group_key(group_)
+                                ) or self._get_group(harvest_object.source.url, group_)
                             except RemoteResourceError:
                                 log.error("Could not get remote group %s", group_)
                                 continue
 
-                            for key in [
-                                "packages",
-                                "created",
-                                "users",
-                                "groups",
-                                "tags",
-                                "extras",
-                                "display_name",
-                            ]:
+                            for key in GROUP_DROP_KEYS:
                                 group.pop(key, None)
 
                             get_action("group_create")(base_context.copy(), group)
@@ -649,9 +918,7 @@ class DataPressHarvester(HarvesterBase, DFLHarvesterMixin):
                 package_dict["groups"] = validated_groups
             
             # Local harvest source organization
-            harvest_source = get_action("package_show")(
-                base_context.copy(), {"id": harvest_object.source.id}
-            )
+            harvest_source = self._get_harvest_source(base_context, harvest_object)
 
             harvester_org = harvest_source.get("owner_org")
 
@@ -679,99 +946,94 @@ class DataPressHarvester(HarvesterBase, DFLHarvesterMixin):
             if default_groups:
                 if "groups" not in package_dict:
                     package_dict["groups"] = []
-                existing_group_ids = [g["id"] for g in package_dict["groups"]]
+                existing_group_ids = {g["id"] for g in package_dict["groups"]}
                 package_dict["groups"].extend(
                     [
-                        g
+                        dict(g)
                         for g in self.config["default_group_dicts"]
                         if g["id"] not in existing_group_ids
                     ]
                 )
 
-            if "extras" not in package_dict:
-                package_dict["extras"] = []
-
-            default_extras = {}
-            default_extras.update(self.config.get("default_extras", {}))
+            extras = package_dict.setdefault("extras", [])
 
-            def get_extra(key, package_dict):
-                for extra in package_dict.get("extras", []):
-                    if extra["key"] == key:
-                        return extra
+            default_extras = self.config.get("default_extras", {})
 
             if default_extras:
                 override_extras = self.config.get("override_extras", False)
+                # Index the extras by key (keeping the first of any duplicates)
+                # rather than scanning the list for every default extra
+                extras_by_key = {e["key"]: e for e in reversed(extras)}
+                # Replacement strings that can be used in the default extras
+                source = harvest_object.job.source
+                format_kwargs = {
+                    "harvest_source_id": source.id,
+                    "harvest_source_url": source.url.strip("/"),
+                    "harvest_source_title": source.title,
+                    "harvest_source_frequency": source.frequency,
+                    "harvest_job_id": harvest_object.job.id,
+                    "harvest_object_id": ho_id,
+                    "dataset_id": pkg_id,
+                }
+                new_extras = []
                 for key, value in default_extras.items():
-                    existing_extra = get_extra(key, package_dict)
+                    existing_extra = extras_by_key.get(key)
                     if existing_extra and not override_extras:
                         continue  # no need for the default
                     if existing_extra:
-                        package_dict["extras"].remove(existing_extra)
+                        extras.remove(existing_extra)
                     # Look for replacement strings
                     if isinstance(value, str):
-                        value = value.format(
-                            harvest_source_id=harvest_object.job.source.id,
-                            harvest_source_url=harvest_object.job.source.url.strip("/"),
-                            harvest_source_title=harvest_object.job.source.title,
-                            harvest_source_frequency=harvest_object.job.source.frequency,
-                            harvest_job_id=harvest_object.job.id,
-                            harvest_object_id=harvest_object.id,
-                            dataset_id=package_dict["id"],
-                        )
+                        value = value.format(**format_kwargs)
+
+                    new_extras.append(package_extra(key, value))
 
-                    package_dict["extras"].append({"key": key, "value": value})
+                extras.extend(new_extras)
 
             # Add any existing extras here so they override any default extras
             # specified in the harvest source. E.g. if data_quality is set as a default_extra
             # we want to override that with whatever the current value is.
-            add_existing_extras(package_dict, base_context.copy())
+            existing_extras = add_existing_extras(package_dict, base_context.copy())
+
+            # Skip datasets that haven't changed upstream (or in the harvest
+            # source config) since they were last imported, rather than
+            # running them through package_update again. Datasets that have
+            # been deleted locally are still imported, to restore them
+            if (
+                get_package_extra_val(existing_extras, "upstream_content_hash")
+                == content_hash
+                and self._get_package_state(pkg_id) == "active"
+            ):
+                log.debug("Dataset %s is unchanged, skipping", pkg_id)
+                return "unchanged"
+            upsert_package_extra(extras, "upstream_content_hash", content_hash)
 
             # Add some default extras
             add_default_extras(package_dict)
 
-            package_dict["extras"] += [
-                {
-                    "key": "upstream_url",
-                    "value": "{}/dataset/{}".format(
-                        harvest_object.job.source.url.rstrip("/"),
-                        package_dict["id"],
-                    ),
-                },
-                {
-                    "key": "upstream_metadata_modified",
-                    "value": package_dict["metadata_modified"],
-                },
-                {
-                    "key": "upstream_metadata_created",
-                    "value": package_dict["metadata_created"],
-                },
-            ]
+            extras.extend(
+                [
+                    package_extra("upstream_url", f"{source_url}/dataset/{pkg_id}"),
+                    package_extra("upstream_metadata_modified", metadata_modified),
+                    package_extra("upstream_metadata_created", metadata_created),
+                ]
+            )
 
             normalise_ckan_resources(package_dict)
-            
-            for resource in package_dict.get("resources", []):
-                
-                # Clear remote url_type for resources (eg datastore, upload) as
-                # we are only creating normal resources with links to the
-                # remote ones
-                resource.pop("url_type", None)
-
-                # Clear revision_id as the revision won't exist on this CKAN
-                # and saving it will cause an IntegrityError with the foreign
-                # key.
-                resource.pop("revision_id", None)
 
-                # if "extras" not in resource:
-                #     resource["extras"] = []
-
-            package_dict_form = self.modify_package_dict(package_dict, harvest_object)
+            # The extra fields modify_package_dict reads are left as they
+            # were upstream by the transformations above, so there's no need
+            # to parse harvest_object.content a second time
+            package_dict_form = self.modify_package_dict(
+                package_dict, harvest_object, unprocessed_dataset_dict=package_dict
+            )
             result = self._create_or_update_package(
                 package_dict_form, harvest_object, package_dict_form="package_show"
             )
 
             return result
         except ValidationError as e:
-            log.exception("ValidationError during Import")
+            log.exception("ValidationError during Import for %s", harvest_object.guid)
 
             self._save_object_error(
                 "Invalid package with GUID %s: %r"
@@ -780,8 +1042,8 @@ class DataPressHarvester(HarvesterBase, DFLHarvesterMixin):
                 "Import",
             )
         except Exception as e:
-            log.exception("Exception during Import")
-            self._save_object_error("%s" % e, harvest_object, "Import")
+            log.exception("Exception during Import for %s", harvest_object.guid)
+            self._save_object_error(str(e), harvest_object, "Import")
 
 
 class ContentFetchError(Exception):
@@ -796,8 +1058,53 @@ class RemoteResourceError(Exception):
     pass
 
 
+# The same author/maintainer emails and resource names turn up across many
+# datasets in a harvest, so memoise the percent-encoding.
+@functools.lru_cache(maxsize=4096)
+def quote(string, safe="/"):
+    return urllib.parse.quote(string, safe=safe)
+
+
+def _resource_url(package_dict, resource):
+    """The url a DataPress resource is imported with"""
+    # these URLs are forbidden, so we need to reconstruct the
+    # data.london.gov URLs
+    # TODO this is specific to data.london.gov.uk, we need a way to make
+    # tweaks like this on a per-datapress-instance basis.
+    # Do all DataPress instances work similarly? Can we use the harvest
+    # URL here?
+    if resource["url"].startswith(AIRDRIVE_PREFIX):
+        return LONDON_DOWNLOAD_URL.format(
+            dataset=package_dict["name"],
+            id=resource["id"],
+            file=quote(resource["name"]),
+            format=resource["format"],
+        )
+    return resource["url"]
+
+
+def _group_key(group_):
+    """The id used to look up a remote group: its id, or its name if it has no id"""
+    return group_.get("id") or group_.get("name")
+
+
 # This makes me uncomfortable, but CKAN doesn't accept time zone specifiers so
 # we have to strip them. If we ever need to harvest a source in another time
 # zone we'll have to update CKAN to handle them.
 def strip_time_zone(iso_timestamp):
-    return re.sub(r"Z|([+-]\d\d:?(\d\d)?)$", "", iso_timestamp)
+    if iso_timestamp.endswith("Z"):
+        return iso_timestamp[:-1]
+
+    # Otherwise look for a numeric offset after the time: +HH:MM, +HHMM
+    # or +HH (or the same with a -)
+    time_start = iso_timestamp.find("T")
+    sign = max(iso_timestamp.rfind("+"), iso_timestamp.rfind("-"))
+    if time_start == -1 or sign < time_start:
+        return iso_timestamp
+
+    offset = iso_timestamp[sign + 1 :]
+    if len(offset) == 5 and offset[2] == ":":
+        offset = offset[:2] + offset[3:]
+    if len(offset) in (2, 4) and offset.isdigit():
+        return iso_timestamp[:sign]
+    return iso_timestamp
@@ -1,51 +1,203 @@
 import logging
 import csv
+import functools
+import hashlib
+import threading
+from collections import defaultdict
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from ckan import model
+from ckan.lib.helpers import json
 from ckan.logic import get_action, NotFound
 
+__all__ = ["DFLHarvesterMixin"]
+
 log = logging.getLogger(__name__)
 
-PROVIDER_ORG_MAPPINGS = {}
-try:
-    with open("organisation_mappings.csv", mode='r', encoding='utf-8-sig') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            provider_id = row["Provider"]
-            original_id = row["Original ID"]
-            if provider_id not in PROVIDER_ORG_MAPPINGS:
-                PROVIDER_ORG_MAPPINGS[provider_id] = {}
-            if original_id not in PROVIDER_ORG_MAPPINGS[provider_id]:
-                PROVIDER_ORG_MAPPINGS[provider_id][original_id] = {}
-                
-            PROVIDER_ORG_MAPPINGS[provider_id][original_id]['name'] = row["Override ID"]
-            PROVIDER_ORG_MAPPINGS[provider_id][original_id]['title'] = row["Override Title"]     
-
-except BaseException as ex:    
-    log.info(f"No organisation_mappings.csv file was provided to canonicalise organisation names {ex}")
-    
-# Makes an attempt to canonicalise a string from either an org id, or
-# an org name slug and canonicalises it into the org name for mapping,
-# though if there is no record of the organisation stored it will
-# return the input id.
-#
-# Also note if the id passed matches an org with an updated name then this will
-# also constitute a remapping.
-#
-def canonicalise_org_to_name(base_context, org_name_or_id):
+# Keys of a remote organization dict that aren't passed on to organization_create
+_DROP_ORG_KEYS = frozenset(
+    (
+        "packages",
+        "created",
+        "users",
+        "groups",
+        "tags",
+        "extras",
+        "display_name",
+        "type",
+    )
+)
+
+# Guards the lazy creation of the harvesters' HTTP sessions, which are first
+# used from thread pools during the gather
+_HTTP_SESSION_LOCK = threading.Lock()
+
+
+@functools.lru_cache(maxsize=1)
+def get_provider_org_mappings():
+    """
+    Returns the organisation mappings from organisation_mappings.csv, as
+    {provider: {original_id: {'name': override_id, 'title': override_title}}}
+    The file is only read the first time a mapping is needed, not on every
+    import of the harvesters.
+    """
     try:
-        org_name = get_action('organization_show')(base_context, data_dict={'id': org_name_or_id})['name']
-        return org_name
-    except NotFound:
-        return org_name_or_id
-    
+        with open("organisation_mappings.csv", mode='r', encoding='utf-8-sig') as csvfile:
+            reader = csv.reader(csvfile)
+            header = next(reader, None)
+            if header is None:
+                log.info("organisation_mappings.csv is empty")
+                return {}
+            provider, original_id, override_id, override_title = (
+                header.index(column)
+                for column in ("Provider", "Original ID", "Override ID", "Override Title")
+            )
+            mappings = defaultdict(dict)
+            for row in reader:
+                # Skip blank and incomplete rows, as DictReader did
+                if len(row) < len(header):
+                    continue
+                mappings[row[provider]][row[original_id]] = {
+                    'name': row[override_id],
+                    'title': row[override_title],
+                }
+            return dict(mappings)
+
+    except FileNotFoundError as ex:
+        log.info(f"No organisation_mappings.csv file was provided to canonicalise organisation names {ex}")
+        return {}
+
+
+@functools.lru_cache(maxsize=1)
+def get_provider_org_mappings_digest():
+    """
+    Returns a hash of the organisation mappings, so harvesters can tell when
+    the mappings a dataset was imported with have changed.
+    """
+    mappings = json.dumps(get_provider_org_mappings(), sort_keys=True)
+    return hashlib.sha256(mappings.encode()).hexdigest()
+
+
+def _new_http_session():
+    session = requests.Session()
+    # Retry idempotent requests (GET/HEAD) that fail to connect or get
+    # a gateway error, with a short backoff, instead of failing the
+    # whole gather on a single dropped connection. If the gateway
+    # errors persist, the last response is returned rather than
+    # raising a RetryError, so callers can handle it as before
+    retries = Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=(502, 503, 504),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=retries)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
 class DFLHarvesterMixin:
+    @property
+    def http_session(self):
+        """
+        A requests.Session shared by all of this harvester's HTTP requests,
+        so that connections are kept alive and reused rather than opening a
+        new connection (and TLS handshake) for every request.
+        """
+        if getattr(self, "_http_session", None) is None:
+            with _HTTP_SESSION_LOCK:
+                # Check again, in case another thread created it while this
+                # one was waiting for the lock
+                if getattr(self, "_http_session", None) is None:
+                    self._http_session = _new_http_session()
+        return self._http_session
+
+    def _get_job_cache(self, harvest_object):
+        """
+        Return a dict for memoising lookups that don't change during a harvest job.
+
+        Harvester instances live as long as the harvest consumer process, so the
+        cache is thrown away as soon as an object from a different job turns up.
+        """
+        job_id = harvest_object.harvest_job_id
+        if getattr(self, "_job_cache_id", None) != job_id:
+            self._job_cache_id = job_id
+            self._job_cache = {}
+        return self._job_cache
+
+    def _get_harvest_source(self, base_context, harvest_object):
+        """
+        Return the package dict of the harvest source that harvest_object belongs to.
+        It's the same for every object in a job, so it is only fetched once per job.
+        """
+        cache = self._get_job_cache(harvest_object)
+        if "harvest_source" not in cache:
+            cache["harvest_source"] = get_action("package_show")(
+                base_context.copy(), {"id": harvest_object.source.id}
+            )
+        return cache["harvest_source"]
+
+    def _get_local_groups(self, harvest_object, is_organization):
+        """
+        Return the job's memo of local groups (or organizations), keyed by both
+        id and name. It starts off holding the id and name of every active one,
+        loaded with a single query, so most lookups need no action call at all.
+        """
+        key = "organizations" if is_organization else "groups"
+        cache = self._get_job_cache(harvest_object)
+        if key not in cache:
+            groups = cache[key] = {}
+            query = model.Session.query(model.Group.id, model.Group.name).filter(
+                model.Group.state == "active",
+                model.Group.is_organization == is_organization,
+            )
+            for group_id, group_name in query:
+                groups[group_id] = groups[group_name] = {
+                    "id": group_id,
+                    "name": group_name,
+                }
+        return cache[key]
+
+    def _show_organization(self, base_context, harvest_object, org_name_or_id):
+        """
+        organization_show, memoised for the rest of the harvest job since most
+        datasets belong to a handful of organizations. Organizations that
+        aren't found aren't cached, as they may be created later in the job.
+        """
+        orgs = self._get_local_groups(harvest_object, is_organization=True)
+        if org_name_or_id not in orgs:
+            orgs[org_name_or_id] = get_action("organization_show")(
+                base_context.copy(), {"id": org_name_or_id}
+            )
+        return orgs[org_name_or_id]
+
+    # Makes an attempt to canonicalise a string from either an org id, or
+    # an org name slug and canonicalises it into the org name for mapping,
+    # though if there is no record of the organisation stored it will
+    # return the input id.
+    #
+    # Also note if the id passed matches an org with an updated name then this will
+    # also constitute a remapping.
+    #
+    def canonicalise_org_to_name(self, base_context, harvest_object, org_name_or_id):
+        try:
+            return self._show_organization(
+                base_context, harvest_object, org_name_or_id
+            )["name"]
+        except NotFound:
+            return org_name_or_id
+
     def get_mapped_organization(self, base_context, harvest_object, organization_id, remote_orgs, package_dict, org_link):
         validated_org = None
 
-        source_name = get_action('harvest_source_show')(base_context.copy(),{'id':harvest_object.source.id}).get('name')
+        source_name = self._get_harvest_source(base_context, harvest_object).get('name')
 
-        org_name = canonicalise_org_to_name(base_context.copy(), organization_id)
+        org_name = self.canonicalise_org_to_name(base_context, harvest_object, organization_id)
         
-        mapped_org = PROVIDER_ORG_MAPPINGS.get(source_name,{}).get(org_name)
+        mapped_org = get_provider_org_mappings().get(source_name,{}).get(org_name)
 
         if mapped_org:
             log.info(f'Remapped from org name: {org_name} to {mapped_org["name"]}' )
@@ -53,8 +205,8 @@ class DFLHarvesterMixin:
         data_dict = {"id": mapped_org['name'] if mapped_org else org_name}
             
         try:
-            org = get_action("organization_show")(
-                base_context.copy(), data_dict
+            org = self._show_organization(
+                base_context, harvest_object, data_dict["id"]
             )
             validated_org = org["id"]
             log.info(f'Org {validated_org} exists')
@@ -67,26 +219,16 @@ class DFLHarvesterMixin:
                     org = {'name': org_name, 'title': package_dict.get('org_name', org_name)}
                     log.warn(f'Could not find an organization in package_dict falling back: {org}')
 
+                # Copy the org without the keys organization_create shouldn't
+                # get, so the following changes don't touch package_dict
+                org = {k: v for k, v in org.items() if k not in _DROP_ORG_KEYS}
+
                 if mapped_org:
                     org["title"] = mapped_org.get('title') or mapped_org['name']
                     org["name"] = mapped_org['name']
-                
-                for key in [
-                    "packages",
-                    "created",
-                    "users",
-                    "groups",
-                    "tags",
-                    "extras",
-                    "display_name",
-                    "type",
-                ]:
-                    org.pop(key, None)
 
                 if org_link is not None:
-                    org = {**org,
-                            "extras": [{"key": "Website",
-                                        "value": org_link}]}
+                    org["extras"] = [{"key": "Website", "value": org_link}]
 
                 log.info(f'Attempt to create {org["name"]}')
                 new_org = get_action("organization_create")(base_context.copy(), org)
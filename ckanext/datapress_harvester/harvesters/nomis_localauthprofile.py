@@ -2,11 +2,9 @@ import logging
 import requests
 import hashlib
 import datetime
-
-from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor
 
 from ckan import model
-from ckan.lib.helpers import json
 import ckan.plugins.toolkit as tk
 
 from ckanext.harvest.harvesters import HarvesterBase
@@ -14,22 +12,29 @@ from ckanext.harvest.model import HarvestObject
 from .mixins import DFLHarvesterMixin
 from ckanext.datapress_harvester.util import (
     NOMIS_BOROUGHS,
+    NOMIS_BOROUGHS_SET,
     NOMIS_LAP_SELECT_URL,
     NOMIS_LMP_BASE,
     sanitise,
     get_package_extra_val,
-    upsert_package_extra,
+    json_dumps,
+    json_loads,
+    save_harvest_objects,
+    upsert_package_extras,
     add_default_extras,
     add_existing_extras,
 )
 
 log = logging.getLogger(__name__)
 
+# Seconds to wait to connect to nomis, and between bytes of its responses,
+# so a stalled page can't hang the gather indefinitely
+REQUEST_TIMEOUT = 60
+
 
-def _generate_resource(dataset, url_key, name):
+def _generate_resource(dataset, url_key, name, modified):
     """Generate a resource dict for use in a package_dict"""
     resource_id = f'{dataset["resource_id"]}_{url_key}'
-    modified = datetime.datetime.now().isoformat()
     return {
         "id": resource_id,
         "package_id": dataset["package_id"],
@@ -42,6 +47,7 @@ def _generate_resource(dataset, url_key, name):
 
 def _dataset_to_pkgdict(dataset):
     """Convert a scraped dataset to a CKAN package_dict"""
+    # Use the same timestamp for the package and all its resources
     modified = datetime.datetime.now().isoformat()
     return {
         "id": dataset["package_id"],
@@ -50,8 +56,8 @@ def _dataset_to_pkgdict(dataset):
         "notes": dataset["description"],
         "license_id": dataset["license_id"],
         "resources": [
-            _generate_resource(dataset, "sectionlink", "nomis data tables"),
-            _generate_resource(dataset, "querylink", "query the nomis data"),
+            _generate_resource(dataset, "sectionlink", "nomis data tables", modified),
+            _generate_resource(dataset, "querylink", "query the nomis data", modified),
         ],
         "metadata_modified": modified,
         "upstream_metadata_created": modified,
@@ -76,7 +82,7 @@ class NomisLocalAuthorityProfileScraper(HarvesterBase, DFLHarvesterMixin):
         # Check that it is a list with at least one element,
         # and check that each element is one of the NOMIS_BOROUGHS
         try:
-            source_config_obj = json.loads(source_config)
+            source_config_obj = json_loads(source_config)
             if "boroughs" in source_config_obj:
                 if not isinstance(source_config_obj["boroughs"], list):
                     raise ValueError("boroughs must be a list")
@@ -84,12 +90,11 @@ class NomisLocalAuthorityProfileScraper(HarvesterBase, DFLHarvesterMixin):
                 if len(source_config_obj["boroughs"]) == 0:
                     raise ValueError("At least one borough must be specified")
 
-                invalid_boroughs = list(
-                    filter(
-                        lambda b: b not in NOMIS_BOROUGHS,
-                        source_config_obj["boroughs"],
-                    )
-                )
+                invalid_boroughs = [
+                    b
+                    for b in source_config_obj["boroughs"]
+                    if b not in NOMIS_BOROUGHS_SET
+                ]
                 if len(invalid_boroughs) > 0:
                     raise ValueError(
                         f"The following boroughs were not recognised: {', '.join(invalid_boroughs)}"
@@ -103,7 +108,7 @@ class NomisLocalAuthorityProfileScraper(HarvesterBase, DFLHarvesterMixin):
 
     def _set_config(self, config_str):
         if config_str:
-            self.config = json.loads(config_str)
+            self.config = json_loads(config_str)
             if "api_version" in self.config:
                 self.api_version = int(self.config["api_version"])
 
@@ -115,17 +120,24 @@ class NomisLocalAuthorityProfileScraper(HarvesterBase, DFLHarvesterMixin):
         For each of the boroughs in the Select box on the nomis local authority profile page which matches
         one of the required_boroughs
         """
+        # Only the options of the select box are needed, so read them with
+        # lxml directly rather than building a BeautifulSoup tree of the page
+        from lxml import etree, html
+
         try:
-            page = BeautifulSoup(requests.get(NOMIS_LAP_SELECT_URL).text)
-        except requests.exceptions.ConnectionError as e:
+            response = self.http_session.get(
+                NOMIS_LAP_SELECT_URL, timeout=REQUEST_TIMEOUT
+            )
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
             self._save_gather_error(
                 f"Connection error when getting borough IDs: {NOMIS_LAP_SELECT_URL}",
                 harvest_job,
             )
             return {}
         try:
-            nomis_local_authorities = page.find("select").findChildren("option")
-        except AttributeError as e:
+            page = html.fromstring(response.content)
+            nomis_local_authorities = page.xpath("(//select)[1]//option")
+        except etree.ParserError as e:
             nomis_local_authorities = []
 
         if len(nomis_local_authorities) == 0:
@@ -133,23 +145,32 @@ class NomisLocalAuthorityProfileScraper(HarvesterBase, DFLHarvesterMixin):
             self._save_gather_error(msg, harvest_job)
             return {}
 
+        required_boroughs = frozenset(required_boroughs)
         return {
-            option.text: option["value"]
+            option.text_content(): option.get("value")
             for option in nomis_local_authorities
-            if option.text in required_boroughs
+            if option.text_content() in required_boroughs
         }
 
+    def _fetch_borough_page(self, url):
+        """
+        Returns the content of a local authority profile page,
+        or None if it couldn't be reached
+        """
+        try:
+            return self.http_session.get(url, timeout=REQUEST_TIMEOUT).content
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            return None
+
     def _extract_topics(self, page, url, harvest_job):
         """
         Returns a list of dictionaries of the form [{"name": <name>, "location": <location>}, {...}]
         for each topic in the summary box on a local authority profile page
         """
         try:
-            topic_links = (
-                page.find(class_="summary-stat-overview-section-wrapper")
-                .find("ul", class_="links-list")
-                .findAll("li")
-            )
+            topic_links = page.select_one(
+                ".summary-stat-overview-section-wrapper ul.links-list"
+            ).find_all("li")
         except AttributeError as e:
             topic_links = []
 
@@ -163,13 +184,14 @@ class NomisLocalAuthorityProfileScraper(HarvesterBase, DFLHarvesterMixin):
         ]
         return topics
 
-    def _extract_dataset(self, page, borough_name, borough_id, topic, harvest_job):
+    def _extract_dataset(self, anchors, borough_name, borough_id, topic, harvest_job):
         """
         Returns a dataset dictionary corresponding to one of the topics
         on a nomis local authority profile page.
+        anchors is a dictionary of the page's named <a> tags, keyed by name.
         """
         # Find the <a> tag that signifys the start of a 'topic'
-        topic_start = page.find("a", {"name": topic["location"].replace("#", "")})
+        topic_start = anchors.get(topic["location"].replace("#", ""))
         if topic_start is None:
             self._save_gather_error(
                 f"Did not find topic: {topic['name']} start for {borough_name}",
@@ -195,9 +217,9 @@ class NomisLocalAuthorityProfileScraper(HarvesterBase, DFLHarvesterMixin):
             )
             return None
 
-        md5 = hashlib.md5()
-        content_hash = md5.update(table_content.encode())
-        content_hash = md5.hexdigest()
+        content_hash = hashlib.blake2b(
+            table_content.encode(), digest_size=16
+        ).hexdigest()
 
         name = f"{borough_name} {topic['name']}"
         package_id = f"nomis_{sanitise(name)}"
@@ -216,6 +238,10 @@ class NomisLocalAuthorityProfileScraper(HarvesterBase, DFLHarvesterMixin):
         }
 
     def gather_stage(self, harvest_job):
+        # bs4 is only needed while scraping, so don't import it (and make every
+        # CKAN process that loads the harvester plugins pay for it) until then
+        from bs4 import BeautifulSoup
+
         self._set_config(harvest_job.source.config)
         log.info("Getting borough ids")
 
@@ -227,45 +253,65 @@ class NomisLocalAuthorityProfileScraper(HarvesterBase, DFLHarvesterMixin):
             )
             return None
 
+        borough_urls = {
+            name: NOMIS_LMP_BASE.format(nomis_code=code)
+            for name, code in scraped_boroughs.items()
+        }
+        # The borough pages don't depend on each other, so download them
+        # concurrently rather than one after another
+        log.info(f"Fetching pages for {len(borough_urls)} boroughs")
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            borough_pages = dict(
+                zip(
+                    borough_urls,
+                    executor.map(self._fetch_borough_page, borough_urls.values()),
+                )
+            )
+
         datasets = []
+        failed_topics = 0
         for name, code in scraped_boroughs.items():
             log.info(f"Extracting datasets for {name}")
-            borough_url = NOMIS_LMP_BASE.format(nomis_code=code)
-            try:
-                borough_page = BeautifulSoup(requests.get(borough_url).content)
-            except requests.exceptions.ConnectionError as e:
+            borough_url = borough_urls[name]
+            if borough_pages[name] is None:
                 self._save_gather_error(
                     f"Connection error when getting page for {name}", harvest_job
                 )
                 continue
+            borough_page = BeautifulSoup(borough_pages[name], "lxml")
             topics = self._extract_topics(borough_page, borough_url, harvest_job)
-            datasets += [
-                self._extract_dataset(borough_page, name, code, t, harvest_job)
-                for t in topics
-            ]
-
-        if None in datasets:
-            self._save_gather_error(
-                "Some datasets were not extracted correctly. Stopping."
-            )
-            return []
+            # Index the named <a> tags that mark the start of each topic in one
+            # pass over the page, rather than searching the page for every topic
+            anchors = {}
+            for anchor in borough_page.find_all("a", attrs={"name": True}):
+                anchors.setdefault(anchor["name"], anchor)
+            for t in topics:
+                # _extract_dataset saves a gather error for any topic it
+                # can't extract, so just carry on with the rest
+                dataset = self._extract_dataset(anchors, name, code, t, harvest_job)
+                if dataset is None:
+                    failed_topics += 1
+                else:
+                    datasets.append(dataset)
+
+        if failed_topics:
+            log.warning(f"Failed to extract {failed_topics} datasets")
 
         log.info(f"Extracted {len(datasets)} datasets in total")
 
         # Create harvest objects for each dataset
         log.info(f"Converting datasets into HarvestObjects")
-        object_ids = []
         try:
-            for d in datasets:
-                obj = HarvestObject(
-                    guid=d["package_id"], job=harvest_job, content=json.dumps(d)
+            harvest_objects = [
+                HarvestObject(
+                    guid=d["package_id"], job=harvest_job, content=json_dumps(d)
                 )
-                obj.save()
-                object_ids.append(obj.id)
-            return object_ids
+                for d in datasets
+            ]
+            return save_harvest_objects(harvest_objects)
         except Exception as e:
             log.exception("Unexpected exception during gather")
-            self._save_gather_error("%r" % e.message, harvest_job)
+            self._save_gather_error("%r" % e, harvest_job)
 
     def fetch_stage(self, harvest_object):
         return True
@@ -277,7 +323,7 @@ class NomisLocalAuthorityProfileScraper(HarvesterBase, DFLHarvesterMixin):
             "user": self._get_user_name(),
         }
 
-        scraped_dataset = json.loads(harvest_object.content)
+        scraped_dataset = json_loads(harvest_object.content)
 
         # Check whether a dataset already exists in CKAN.
         # If so, check the content hashes to see if the data has been updated upstream
@@ -303,12 +349,12 @@ class NomisLocalAuthorityProfileScraper(HarvesterBase, DFLHarvesterMixin):
         try:
             # Merge our scraped package dict into any existing package dict
             # The keys in the dict returned by _dataset_to_pkgdict will override those in existing_dataset
-            package_dict = {**existing_dataset, **_dataset_to_pkgdict(scraped_dataset)}
+            # existing_dataset isn't used again, so it's updated in place rather than copied
+            package_dict = existing_dataset
+            package_dict.update(_dataset_to_pkgdict(scraped_dataset))
 
             # Set the owner org of the new dataset to the org set in the harvest source
-            harvest_source = tk.get_action("package_show")(
-                base_context.copy(), {"id": harvest_object.source.id}
-            )
+            harvest_source = self._get_harvest_source(base_context, harvest_object)
 
             org = harvest_source.get("owner_org")
             remote_orgs = self.config.get("remote_orgs", None)   
@@ -335,15 +381,15 @@ class NomisLocalAuthorityProfileScraper(HarvesterBase, DFLHarvesterMixin):
             # Add some default package[extras]
             add_default_extras(package_dict)
 
-            # Add the content hash or update the value if one existed
-            upsert_package_extra(
-                package_dict["extras"], "content_hash", scraped_dataset["content_hash"]
-            )
-            upsert_package_extra(
-                package_dict["extras"], "harvest_source_frequency", harvest_object.source.frequency
-            )
-            upsert_package_extra(
-                package_dict["extras"], "harvest_source_borough_name", scraped_dataset["borough_name"]
+            # Add the content hash, source frequency and borough name,
+            # or update the values if they already existed
+            upsert_package_extras(
+                package_dict["extras"],
+                {
+                    "content_hash": scraped_dataset["content_hash"],
+                    "harvest_source_frequency": harvest_object.source.frequency,
+                    "harvest_source_borough_name": scraped_dataset["borough_name"],
+                },
             )
 
             result = self._create_or_update_package(
@@ -2,9 +2,9 @@ import logging
 import requests
 import hashlib
 import xmltodict
+from concurrent.futures import ThreadPoolExecutor
 
 from ckan import model
-from ckan.lib.helpers import json
 import ckan.plugins.toolkit as toolkit
 
 from ckanext.harvest.harvesters import HarvesterBase
@@ -18,11 +18,19 @@ from ckanext.datapress_harvester.util import (
     add_default_keys,
     add_default_extras,
     add_existing_extras,
+    json_dumps,
+    json_loads,
+    save_harvest_objects,
 )
 from .mixins import DFLHarvesterMixin
 log = logging.getLogger(__name__)
 
 REDBRIDGE_API_URL = "http://data.redbridge.gov.uk/api/"
+# The most requests to make to the Redbridge API at once
+MAX_CONCURRENT_REQUESTS = 8
+# Seconds to wait to connect to the Redbridge API, and between bytes of its
+# responses, so a stalled request can't hang the gather indefinitely
+REQUEST_TIMEOUT = 60
 
 
 def _generate_resource(package_id, dataset, is_csv):
@@ -31,9 +39,7 @@ def _generate_resource(package_id, dataset, is_csv):
     if is_csv:
         url = url.replace("XML", "CSV")
 
-    sha1 = hashlib.sha1()
-    resource_id = sha1.update(url.encode())
-    resource_id = sha1.hexdigest()
+    resource_id = hashlib.sha1(url.encode()).hexdigest()
 
     return {
         "id": resource_id,
@@ -53,7 +59,7 @@ class RedbridgeHarvester(HarvesterBase, DFLHarvesterMixin):
             return config
 
         try:
-            config_obj = json.loads(config)
+            config_obj = json_loads(config)
             if "remote_orgs" in config_obj:
                 if config_obj["remote_orgs"] != "create":
                     raise ValueError("The redbridge harvester only supports remote_orgs being set to 'create' or not at all")
@@ -74,19 +80,28 @@ class RedbridgeHarvester(HarvesterBase, DFLHarvesterMixin):
 
     def _set_config(self, config_str):
         if config_str:
-            self.config = json.loads(config_str)
+            self.config = json_loads(config_str)
             if "api_version" in self.config:
                 self.api_version = int(self.config["api_version"])
 
             log.debug("Using config: %r", self.config)
 
-    
+    def _fetch_page(self, url):
+        """
+        Returns the text of a page from the Redbridge API,
+        or None if it couldn't be reached
+        """
+        try:
+            return self.http_session.get(url, timeout=REQUEST_TIMEOUT).text
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            return None
+
     def gather_stage(self, harvest_job):
         pkg_dicts = []
 
         try:
-            response = requests.get(REDBRIDGE_API_URL)
-        except requests.exceptions.ConnectionError as e:
+            response = self.http_session.get(REDBRIDGE_API_URL, timeout=REQUEST_TIMEOUT)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
             self._save_gather_error(
                 f"Connection error for Redbridge API: {REDBRIDGE_API_URL}",
                 harvest_job,
@@ -107,36 +122,44 @@ class RedbridgeHarvester(HarvesterBase, DFLHarvesterMixin):
             ]
         ]
 
-        for c in category_urls:
-            try:
-                category = requests.get(c)
-            except requests.exceptions.ConnectionError as e:
-                self._save_gather_error(
-                    f"Connection error for category: {c}",
-                    harvest_job,
-                )
-                continue
+        # The pages at each level of the tree don't depend on each other, so
+        # fetch each level's pages concurrently, a bounded number at a time
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+            schemas_to_fetch = []
+            for c, category in zip(
+                category_urls, executor.map(self._fetch_page, category_urls)
+            ):
+                if category is None:
+                    self._save_gather_error(
+                        f"Connection error for category: {c}",
+                        harvest_job,
+                    )
+                    continue
 
-            schemas = xmltodict.parse(category.text)["ArrayOfRestSchema"]["RestSchema"]
-            if not isinstance(schemas, list):
-                schemas = [schemas]
+                schemas = xmltodict.parse(category)["ArrayOfRestSchema"]["RestSchema"]
+                if not isinstance(schemas, list):
+                    schemas = [schemas]
 
-            for s in schemas:
+                for s in schemas:
+                    schemas_to_fetch.append((s, f"{c}/{s['FriendlyUrl']}"))
+
+            datasets_pages = executor.map(
+                self._fetch_page,
+                [datasets_url for s, datasets_url in schemas_to_fetch],
+            )
+
+            for (s, datasets_url), datasets in zip(schemas_to_fetch, datasets_pages):
                 schema_title = s["Title"]
                 schema_description = s["ShortDescription"]
 
-                datasets_url = f"{c}/{s['FriendlyUrl']}"
-
-                try:
-                    datasets = requests.get(datasets_url)
-                except requests.exceptions.ConnectionError as e:
+                if datasets is None:
                     self._save_gather_error(
                         f"Connection error for category: {datasets_url}",
                         harvest_job,
                     )
                     continue
 
-                datasets_metadata = xmltodict.parse(datasets.text)[
+                datasets_metadata = xmltodict.parse(datasets)[
                     "ArrayOfRestDataSet"
                 ]["RestDataSet"]
                 if not isinstance(datasets_metadata, list):
@@ -144,9 +167,7 @@ class RedbridgeHarvester(HarvesterBase, DFLHarvesterMixin):
 
                 for d in datasets_metadata:
                     full_title = f"Redbrige - {schema_title} - {d['Title']}"
-                    sha1 = hashlib.sha1()
-                    package_id = sha1.update(full_title.encode())
-                    package_id = sha1.hexdigest()
+                    package_id = hashlib.sha1(full_title.encode()).hexdigest()
 
                     package_dict = {
                         "id": package_id,
@@ -176,27 +197,22 @@ class RedbridgeHarvester(HarvesterBase, DFLHarvesterMixin):
         log.info(f"{len(to_be_deleted)} datasets need to be deleted")
 
         # Create harvest objects for each dataset
-        object_ids = []
         try:
-            for p in pkg_dicts:
-                obj = HarvestObject(
-                    guid=p["id"], job=harvest_job, content=json.dumps(p)
-                )
-                obj.save()
-                object_ids.append(obj.id)
+            harvest_objects = [
+                HarvestObject(guid=p["id"], job=harvest_job, content=json_dumps(p))
+                for p in pkg_dicts
+            ]
 
             for i in to_be_deleted:
                 # the dataset_purge function in the import_stage only needs the dataset ID to be able to purge the dataset.
                 pkg_dict = {"id": i, "action": "delete"}
-                obj = HarvestObject(
-                    guid=i, job=harvest_job, content=json.dumps(pkg_dict)
+                harvest_objects.append(
+                    HarvestObject(guid=i, job=harvest_job, content=json_dumps(pkg_dict))
                 )
-                obj.save()
-                object_ids.append(obj.id)
-            return object_ids
+            return save_harvest_objects(harvest_objects)
         except Exception as e:
             log.exception('Unexpected error during gather')
-            self._save_gather_error("%r" % e.message, harvest_job)
+            self._save_gather_error("%r" % e, harvest_job)
 
     def fetch_stage(self, harvest_object):
         return True
@@ -221,7 +237,7 @@ class RedbridgeHarvester(HarvesterBase, DFLHarvesterMixin):
             return False
 
         try:
-            package_dict = json.loads(harvest_object.content)
+            package_dict = json_loads(harvest_object.content)
             if package_dict.get("action", None) == "delete":
                 log.info(f"Deleting dataset with ID: {package_dict['id']}")
                 result = toolkit.get_action("dataset_purge")(
@@ -236,10 +252,8 @@ class RedbridgeHarvester(HarvesterBase, DFLHarvesterMixin):
 
         try:
             # Set the owner org of the new dataset to the org set in the harvest source
-            harvest_source = toolkit.get_action("package_show")(
-                base_context.copy(), {"id": harvest_object.source.id}
-            )
-                        
+            harvest_source = self._get_harvest_source(base_context, harvest_object)
+
             harvester_org = harvest_source.get("owner_org")
 
             config = self.config or {}
@@ -2,6 +2,10 @@ import logging
 import requests
 import hashlib
 import datetime
+from collections import deque
+from itertools import islice
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
 from ckan import model
 from ckan.lib.helpers import json
 import ckan.plugins.toolkit as tk
@@ -17,20 +21,26 @@ from ckanext.datapress_harvester.util import (
     get_harvested_dataset_ids,
     add_default_keys,
     add_default_extras,
-    add_existing_extras
+    json_dumps,
+    json_loads,
+    save_harvest_objects,
 )
 
 log = logging.getLogger(__name__)
 
+# Seconds to wait to connect to the Socrata API, and between bytes of its
+# responses, so a stalled request can't hang the gather indefinitely
+REQUEST_TIMEOUT = 60
+
 # In ckan, we should be able to add a license list such as
 # https://licenses.opendefinition.org/licenses/groups/all.json by setting the ckan.licenses_group_url field in the config, but that doesn't seem to be
 # working as we get an error at http://localhost:5000/api/3/action/license_list
-licenses = {"UK Open Government Licence v3": "OGL-UK-3.0",
+licenses = MappingProxyType({"UK Open Government Licence v3": "OGL-UK-3.0",
             "Public Domain": "other-pd",
             "Open Data Commons Public Domain Dedication and License": "PDDL-1.0",
-            "Creative Commons 1.0 Universal (Public Domain Dedication)": "CC0-1.0"}
+            "Creative Commons 1.0 Universal (Public Domain Dedication)": "CC0-1.0"})
 
-formats = {"application/pdf": "pdf",
+formats = MappingProxyType({"application/pdf": "pdf",
            "application/zip": "zip",
            "application/x-zip-compressed": "zip",
            "text/plain": "txt",
@@ -55,10 +65,19 @@ formats = {"application/pdf": "pdf",
            "application/vnd.ms-powerpoint.addin.macroEnabled.12": "ppam",
            "application/vnd.ms-powerpoint.presentation.macroEnabled.12": "pptm",
            "application/vnd.ms-powerpoint.template.macroEnabled.12": "potm",
-           "application/vnd.ms-powerpoint.slideshow.macroEnabled.12": "ppsm",}
+           "application/vnd.ms-powerpoint.slideshow.macroEnabled.12": "ppsm",})
+
+# The format of the timestamps in the Socrata catalog
+SOCRATA_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
 
 def to_iso_date(opendata_date_str):
-    dt = datetime.datetime.strptime(opendata_date_str, "%Y-%m-%dT%H:%M:%S.%fZ")
+    # fromisoformat is implemented in C and much quicker than strptime, but
+    # before Python 3.11 it only accepts 3 or 6 digit fractions of a second
+    try:
+        dt = datetime.datetime.fromisoformat(opendata_date_str.removesuffix("Z"))
+    except ValueError:
+        dt = datetime.datetime.strptime(opendata_date_str, SOCRATA_DATE_FORMAT)
     return dt.isoformat()
 
 class SODAHarvester(HarvesterBase, DFLHarvesterMixin):
@@ -66,13 +85,20 @@ class SODAHarvester(HarvesterBase, DFLHarvesterMixin):
     domain = None
     app_token = None
     create_organisations = False
+    _config_key = None
 
     def _set_config(self, source):
+        # Every object in a harvest job comes from the same source, so only
+        # parse its config when the url or config differ from last time
+        config_key = (source.url, source.config)
+        if config_key == self._config_key:
+            return
         self.url = source.url.rstrip("/")
         self.domain = self.url.split("://")[1]
-        self.config = json.loads(source.config)
+        self.config = json_loads(source.config)
         self.app_token = self.config["app_token"]
         self.create_organisations = self.config.get("remote_orgs") == "create"
+        self._config_key = config_key
 
     def info(self):
         return {
@@ -83,7 +109,7 @@ class SODAHarvester(HarvesterBase, DFLHarvesterMixin):
         }
 
     def validate_config(self, source_config):
-        source_config_obj = json.loads(source_config)
+        source_config_obj = json_loads(source_config)
         if "app_token" not in source_config:
             raise ValueError("No application token provided in the 'app_token' field")
         return source_config
@@ -102,12 +128,11 @@ class SODAHarvester(HarvesterBase, DFLHarvesterMixin):
             format_id = "csv"
             file_url = f"{self.url}/resource/{ds_id}.csv"
         else:
-            format_id = formats.get(mimetype.split(";")[0])
+            format_id = formats.get(mimetype.partition(";")[0])
             file_url = f"{self.url}/download/{ds_id}/{mimetype}"
         if format_id is None:
             return self._dataset_link_info(ds_id, resource_name)
-        file_ok = requests.get(file_url, headers={"X-App-Token": self.app_token}).ok
-        if file_ok:
+        if self._file_exists(file_url):
             return {"url": file_url,
                     "format": format_id,
                     "name": f"{resource_name}.{format_id}"}
@@ -115,6 +140,29 @@ class SODAHarvester(HarvesterBase, DFLHarvesterMixin):
             return self._dataset_link_info(ds_id, resource_name)
 
 
+    def _file_exists(self, file_url):
+        """Check whether file_url can be downloaded, without downloading it"""
+        headers = {"X-App-Token": self.app_token}
+        try:
+            response = self.http_session.head(
+                file_url, headers=headers, allow_redirects=True, timeout=REQUEST_TIMEOUT
+            )
+            if response.ok:
+                return True
+            # Fall back to a GET for endpoints that don't handle HEAD properly,
+            # e.g. redirects to presigned URLs that are only signed for GET
+            # (stream=True does not download the response body)
+            with self.http_session.get(
+                file_url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT
+            ) as response:
+                return response.ok
+        except requests.exceptions.RequestException as e:
+            # Not being able to reach the file doesn't mean it's missing, so
+            # keep the direct download link rather than switching to the
+            # dataset page, which would change the content hash
+            log.warning(f"Could not check whether {file_url} exists: {e}")
+            return True
+
     def _create_catalog_entry(self, dataset):
         license_name = dataset["metadata"].get("license")
         license_id = licenses.get(license_name, license_name)
@@ -143,42 +191,82 @@ class SODAHarvester(HarvesterBase, DFLHarvesterMixin):
                      "state": "active",
                      "resources": resources}
 
-        md5 = hashlib.md5()
-        content_hash = md5.update(str(pkg_dict).encode())
-        content_hash = md5.hexdigest()
+        # Hash a canonical serialisation, so the hash only changes when the content does
+        # (the standard json module is used here as it can sort the keys)
+        canonical_json = json.dumps(pkg_dict, sort_keys=True, separators=(",", ":"))
+        content_hash = hashlib.blake2b(canonical_json.encode(), digest_size=16).hexdigest()
         log.debug(f'Made entry for {ds_id}')
         return {**pkg_dict, "content_hash": content_hash}
 
-    def gather_stage(self, harvest_job):
-        log.debug("In SODA harvester gather_stage (%s)", str(harvest_job))
-        self._set_config(harvest_job.source)
+    def _iter_catalog_pages(self):
+        """
+        Yields the list of datasets in each page of the source's catalog, in order.
+        Raises CatalogFetchError if the source doesn't respond with a page.
+        """
         catalog_url = f"{self.url}/api/catalog/v1?domains={self.domain}"
         batch_size = 100
-        start_index = 0
-        total_num_results = float("inf")
-        datasets = []
-        while len(datasets) < total_num_results:
-            response = requests.get(catalog_url,
-                                    headers={"X-App-Token": self.app_token},
-                                    params={"limit": batch_size, "offset": start_index})
-            if not response.ok:
-                self._save_gather_error(f"Source URL responded with {response.status_code}",
-                                        harvest_job)
-                return None
 
-            data = response.json()
-            if total_num_results == float("inf"):
-                total_num_results = data["resultSetSize"]
-            datasets.extend(data["results"])
-            start_index += batch_size
-            log.info(f"Fetched {len(datasets)} out of {total_num_results} datasets")
+        def fetch_page(start_index):
+            response = self.http_session.get(catalog_url,
+                                             headers={"X-App-Token": self.app_token},
+                                             params={"limit": batch_size, "offset": start_index},
+                                             timeout=REQUEST_TIMEOUT)
+            if not response.ok:
+                raise CatalogFetchError(f"Source URL responded with {response.status_code}")
+            return json_loads(response.content)
+
+        data = fetch_page(0)
+        total_num_results = data["resultSetSize"]
+        num_fetched = len(data["results"])
+        log.info(f"Fetched {num_fetched} out of {total_num_results} datasets")
+        yield data["results"]
+
+        # Now the number of datasets is known, the rest of the pages don't
+        # depend on each other, so fetch them concurrently. Only a few pages
+        # are requested ahead of the one being yielded, so pages don't pile
+        # up in memory while the caller is still working through earlier ones.
+        max_pages_ahead = 8
+        start_indexes = iter(range(batch_size, total_num_results, batch_size))
+        with ThreadPoolExecutor(max_workers=max_pages_ahead) as executor:
+            pending = deque(
+                executor.submit(fetch_page, start_index)
+                for start_index in islice(start_indexes, max_pages_ahead)
+            )
+            while pending:
+                data = pending.popleft().result()
+                next_start_index = next(start_indexes, None)
+                if next_start_index is not None:
+                    pending.append(executor.submit(fetch_page, next_start_index))
+                num_fetched += len(data["results"])
+                log.info(f"Fetched {num_fetched} out of {total_num_results} datasets")
+                yield data["results"]
 
-        log.info("Converting datasets into HarvestObjects")
+    def gather_stage(self, harvest_job):
+        log.debug("In SODA harvester gather_stage (%s)", str(harvest_job))
+        self._set_config(harvest_job.source)
+        existing_ids = get_harvested_dataset_ids(harvest_job.source.id)
 
-        catalog_entries = [self._create_catalog_entry(d) for d in datasets]
+        # Turn each page of the catalog into serialised catalog entries as it
+        # arrives, so only one page of the (much larger) raw catalog records is
+        # held at a time. The HarvestObjects themselves are only created once
+        # every page has been fetched, so a failed page doesn't leave some
+        # behind in the session.
+        source_ds_ids = set()
+        entries = []
+        try:
+            # Making an entry checks its resource's download link, and the checks
+            # don't depend on each other, so make the entries concurrently
+            with ThreadPoolExecutor(max_workers=16) as executor:
+                for datasets in self._iter_catalog_pages():
+                    for entry in executor.map(self._create_catalog_entry, datasets):
+                        pkg_id = entry["package_id"]
+                        source_ds_ids.add(pkg_id)
+                        entry["action"] = "update" if pkg_id in existing_ids else "create"
+                        entries.append((pkg_id, json_dumps(entry)))
+        except CatalogFetchError as e:
+            self._save_gather_error(str(e), harvest_job)
+            return None
 
-        source_ds_ids = {d["package_id"] for d in catalog_entries}
-        existing_ids = get_harvested_dataset_ids(harvest_job.source.id)
         deleted_ids = existing_ids - source_ds_ids
         log.info(f"""Fetched changes from source:
         {len(source_ds_ids - existing_ids)} to add
@@ -186,33 +274,31 @@ class SODAHarvester(HarvesterBase, DFLHarvesterMixin):
         {len(deleted_ids)} to delete
         """)
 
+        log.info("Converting datasets into HarvestObjects")
         object_ids = []
         try:
-            for d in catalog_entries:
-                pkg_id = d["package_id"]
-                d["action"] = "update" if pkg_id in existing_ids else "create"
-                obj = HarvestObject(
-                    guid=pkg_id, job=harvest_job, content=json.dumps(d)
-                )
-                obj.save()
-                object_ids.append(obj.id)
+            harvest_objects = [
+                HarvestObject(guid=pkg_id, job=harvest_job, content=content)
+                for pkg_id, content in entries
+            ]
+            object_ids.extend(save_harvest_objects(harvest_objects))
         except Exception as e:
-            error_msg = "Error gathering dataset updates: %r" % e.message
+            error_msg = "Error gathering dataset updates: %r" % e
             log.exception(error_msg)
             self._save_gather_error(error_msg, harvest_job)
         try:
-            for pk_id in deleted_ids:
-                obj = HarvestObject(
+            harvest_objects = [
+                HarvestObject(
                     guid=pk_id,
                     job=harvest_job,
-                    content=json.dumps({"id": pk_id, "action": "delete"})
+                    content=json_dumps({"id": pk_id, "action": "delete"})
                 )
-                obj.save()
-                log.info(obj)
-                object_ids.append(obj.id)
+                for pk_id in deleted_ids
+            ]
+            object_ids.extend(save_harvest_objects(harvest_objects))
             return object_ids
         except Exception as e:
-            error_msg = "Error gathering datasets to delete: %r" % e.message
+            error_msg = "Error gathering datasets to delete: %r" % e
             log.exception(error_msg)
             self._save_gather_error(error_msg, harvest_job)
 
@@ -248,7 +334,7 @@ class SODAHarvester(HarvesterBase, DFLHarvesterMixin):
             "user": self._get_user_name(),
         }
 
-        imported_dataset = json.loads(harvest_object.content)
+        imported_dataset = json_loads(harvest_object.content)
 
 
         match imported_dataset["action"]:
@@ -272,11 +358,9 @@ class SODAHarvester(HarvesterBase, DFLHarvesterMixin):
                         org_id = sanitise(package_dict.get("org_name"))
                         owner_org = self.get_mapped_organization(base_context, harvest_object, org_id, self.config.get("remote_orgs"), package_dict, package_dict.get("org_link"))
                     else:
-                        harvest_source = tk.get_action("package_show")(
-                            base_context.copy(), {"id": harvest_object.source.id}
-                        )
+                        harvest_source = self._get_harvest_source(base_context, harvest_object)
                         source_org = harvest_source['organization']['name']
-                            
+
                         owner_org = self.get_mapped_organization(base_context, harvest_object, source_org, self.config.get("remote_orgs"), package_dict, None)
 
                     package_dict["owner_org"] = owner_org
@@ -309,8 +393,10 @@ class SODAHarvester(HarvesterBase, DFLHarvesterMixin):
                         log.info(f"Dataset \"{imported_dataset['name']}\" has not been changed. Skipping.")
                         return "unchanged"
                     else:
+                        # package_dict shares existing_dataset's extras list,
+                        # so its extras are already carried over and there's
+                        # no need for add_existing_extras here
                         package_dict = {**existing_dataset, **self._dataset_to_pkgdict(imported_dataset)}
-                        add_existing_extras(package_dict, base_context.copy())
 
                         upsert_package_extra(
                             package_dict["extras"], "content_hash", imported_dataset["content_hash"]
@@ -327,3 +413,7 @@ class SODAHarvester(HarvesterBase, DFLHarvesterMixin):
                     error_msg = "Error modifying existing dataset: %s" % e
                     log.exception(error_msg)
                     self._save_object_error(error_msg, harvest_object, "Import")
+
+
+class CatalogFetchError(Exception):
+    pass
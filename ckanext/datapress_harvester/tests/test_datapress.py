@@ -0,0 +1,116 @@
+"""
+Tests for harvesters/datapress.py.
+"""
+import pytest
+
+from ckanext.datapress_harvester.harvesters.datapress import (
+    DataPressHarvester,
+    strip_time_zone,
+)
+
+
+@pytest.mark.parametrize(
+    "timestamp, expected",
+    [
+        ("2023-06-27T10:11:12Z", "2023-06-27T10:11:12"),
+        ("2023-06-27T10:11:12.123456Z", "2023-06-27T10:11:12.123456"),
+        ("2023-06-27T10:11:12+01:00", "2023-06-27T10:11:12"),
+        ("2023-06-27T10:11:12-05:30", "2023-06-27T10:11:12"),
+        ("2023-06-27T10:11:12+0100", "2023-06-27T10:11:12"),
+        ("2023-06-27T10:11:12-0500", "2023-06-27T10:11:12"),
+        ("2023-06-27T10:11:12+01", "2023-06-27T10:11:12"),
+        # The offset isn't at a fixed position, as the fractional seconds
+        # are optional and vary in length
+        ("2023-06-27T10:11:12.5+01:00", "2023-06-27T10:11:12.5"),
+        ("2023-06-27T10:11:12.123456-0500", "2023-06-27T10:11:12.123456"),
+        ("2023-06-27T10:11+01:00", "2023-06-27T10:11"),
+        ("2023-06-27T10:11:12", "2023-06-27T10:11:12"),
+        # Only an offset after the time is stripped, not the day of a date
+        ("2023-06-27", "2023-06-27"),
+        ("2023-06-27T10:11:12-", "2023-06-27T10:11:12-"),
+    ],
+)
+def test_strip_time_zone(timestamp, expected):
+    assert strip_time_zone(timestamp) == expected
+
+
+def _extra_fields_lookup(export_packages):
+    return DataPressHarvester()._extra_fields_lookup(iter(export_packages))
+
+
+def test_extra_fields_lookup_dict_resources():
+    lookup = _extra_fields_lookup(
+        [
+            {
+                "id": "pkg-1",
+                "title": "Not an extra field",
+                "update_frequency": "Monthly",
+                "london_smallest_geography": "Borough",
+                "resources": {
+                    "res-1": {
+                        "id": "res-1",
+                        "temporal_coverage_from": "2020-01-01",
+                        "temporal_coverage_to": "2020-12-31",
+                    },
+                    "res-2": {"id": "res-2", "format": "csv"},
+                },
+            }
+        ]
+    )
+
+    assert lookup == {
+        "pkg-1": {
+            "london_smallest_geography": "Borough",
+            "update_frequency": "Monthly",
+            "resources": {
+                "res-1": {
+                    "temporal_coverage_from": "2020-01-01",
+                    "temporal_coverage_to": "2020-12-31",
+                }
+            },
+        }
+    }
+    # The fields come out in the order they're listed, whatever the hash seed
+    assert list(lookup["pkg-1"]) == [
+        "london_smallest_geography",
+        "update_frequency",
+        "resources",
+    ]
+
+
+def test_extra_fields_lookup_list_resources():
+    lookup = _extra_fields_lookup(
+        [
+            {
+                "id": "pkg-1",
+                "resources": [
+                    {"id": "res-1", "temporal_coverage_from": "2020-01-01"},
+                    {"id": "res-2"},
+                ],
+            }
+        ]
+    )
+
+    assert lookup == {
+        "pkg-1": {"resources": {"res-1": {"temporal_coverage_from": "2020-01-01"}}}
+    }
+
+
+def test_extra_fields_lookup_skips_empty_values():
+    lookup = _extra_fields_lookup(
+        [
+            {
+                "id": "pkg-1",
+                "update_frequency": "",
+                "london_smallest_geography": None,
+                "resources": {
+                    "res-1": {"id": "res-1", "temporal_coverage_from": ""},
+                },
+            },
+            {"id": "pkg-2", "update_frequency": "Weekly", "resources": None},
+            {"id": "pkg-3"},
+        ]
+    )
+
+    # Packages without any extra fields are left out altogether
+    assert lookup == {"pkg-2": {"update_frequency": "Weekly"}}
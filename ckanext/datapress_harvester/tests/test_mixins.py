@@ -0,0 +1,38 @@
+"""
+Tests for harvesters/mixins/__init__.py.
+"""
+import pytest
+
+from ckanext.datapress_harvester.harvesters.mixins import get_provider_org_mappings
+
+
+@pytest.fixture
+def mappings_file(tmp_path, monkeypatch):
+    # organisation_mappings.csv is read from the working directory
+    monkeypatch.chdir(tmp_path)
+    get_provider_org_mappings.cache_clear()
+    yield tmp_path / "organisation_mappings.csv"
+    get_provider_org_mappings.cache_clear()
+
+
+def test_get_provider_org_mappings(mappings_file):
+    mappings_file.write_text(
+        "Provider,Original ID,Override ID,Override Title\n"
+        "source,old-org,new-org,New Org\n"
+        "\n"
+        "source,incomplete-row\n"
+    )
+
+    assert get_provider_org_mappings() == {
+        "source": {"old-org": {"name": "new-org", "title": "New Org"}}
+    }
+
+
+def test_get_provider_org_mappings_empty_file(mappings_file):
+    mappings_file.write_text("")
+
+    assert get_provider_org_mappings() == {}
+
+
+def test_get_provider_org_mappings_no_file(mappings_file):
+    assert get_provider_org_mappings() == {}
@@ -0,0 +1,21 @@
+"""
+Tests for util/__init__.py.
+"""
+import pytest
+
+from ckanext.datapress_harvester.util import sanitise
+
+
+@pytest.mark.parametrize(
+    "s, expected",
+    [
+        ("Housing", "housing"),
+        ("Arts & Culture", "arts-culture"),
+        ("Crime  and   Community Safety", "crime-and-community-safety"),
+        ("London_Datastore-2023", "london_datastore-2023"),
+        ("Café (2020/21)!", "caf-202021"),
+        ("", ""),
+    ],
+)
+def test_sanitise(s, expected):
+    assert sanitise(s) == expected
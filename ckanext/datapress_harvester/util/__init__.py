@@ -1,7 +1,20 @@
+import functools
 import re
 
 from ckan import model
+from ckan.lib.helpers import json
 from ckan.plugins import toolkit
+from ckanext.harvest.model import HarvestObject
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
 
 NOMIS_LAP_SELECT_URL = "https://www.nomisweb.co.uk/reports/lmp/la/contents.aspx"
 NOMIS_LMP_BASE = "https://www.nomisweb.co.uk/reports/lmp/la/{nomis_code}/report.aspx"
@@ -41,34 +54,70 @@ NOMIS_BOROUGHS = [
     "Wandsworth",
     "Westminster",
 ]
+NOMIS_BOROUGHS_SET = frozenset(NOMIS_BOROUGHS)
+
+
+def json_loads(s):
+    """
+    Deserialise a JSON document (str or bytes), using orjson or ujson if
+    either is installed.
+    """
+    if orjson is not None:
+        return orjson.loads(s)
+    if ujson is not None:
+        return ujson.loads(s)
+    return json.loads(s)
+
+
+def json_dumps(obj):
+    """
+    Serialise obj to a JSON string, using orjson or ujson if either is installed.
+    Harvest object content is stored as text, so this always returns a str.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    if ujson is not None:
+        return ujson.dumps(obj, escape_forward_slashes=False)
+    return json.dumps(obj)
+
 
+SANITISE_INVALID_CHARS_RE = re.compile(r"[^0-9a-zA-Z _-]+")
+SANITISE_SPACES_RE = re.compile(r" +")
 
+
+@functools.lru_cache(maxsize=1024)
 def sanitise(s):
     """
     Returns a sanitised version of string s:
      - Removes all non-alphanumeric character (except space, underscore and dash)
-     - Replaces duplicate spaces with one space
-     - Replaces remaining spaces with dashes
+     - Replaces each run of spaces with a single dash
      - Lower-cases everything
+    The same strings (topic anchors, organisation names) come up again and again
+    during a harvest, so the results are memoised.
     """
-    without_non_alpha = re.sub("[^0-9a-zA-Z _-]+", "", s)
-    no_duplicate_spaces = re.sub("\s{2,}", " ", without_non_alpha)
-    no_spaces = no_duplicate_spaces.replace(" ", "-")
-    return no_spaces.lower()
+    # Spaces are the only whitespace left after the first substitution, so
+    # collapsing runs of them straight into a dash is the same as collapsing
+    # them into one space and then replacing that
+    without_non_alpha = SANITISE_INVALID_CHARS_RE.sub("", s)
+    return SANITISE_SPACES_RE.sub("-", without_non_alpha).lower()
 
 
 # Helper functions for getting and setting values in package["extras"].
 # package["extras"] is a list of dictionaries of the form:
 # [ {"key": <key>, "value": <value>}, {"key": <key>, "value": <value>}, ...]
+def package_extra(key, value):
+    """
+    Return a single package extra dict for the given key and value.
+    """
+    return {"key": key, "value": value}
+
+
 def remove_extras(extras, keys):
     """
     Return a new dictionary of extras with the specified keys removed.
     """
-    new_extras = []
-    for e in extras:
-        if e["key"] not in keys:
-            new_extras.append({"key": e["key"], "value": e["value"]})
-    return new_extras
+    keys = frozenset(keys)
+    return [package_extra(e["key"], e["value"]) for e in extras if e["key"] not in keys]
 
 
 def get_package_extra_val(extras, key):
@@ -93,10 +142,55 @@ def upsert_package_extra(extras, key, val):
             extra["value"] = val
             return extras
 
-    extras.append({"key": key, "value": val})
+    extras.append(package_extra(key, val))
+    return extras
+
+
+def extras_index(extras):
+    """
+    Return a dictionary of package['extras'] keyed by extra key, for looking up
+    several extras without scanning the list each time.
+    The values are the extra dicts in package['extras'] themselves, so updating
+    them updates package['extras']. If a key appears more than once, the first
+    one is used, as in get_package_extra_val and upsert_package_extra.
+    """
+    return {e["key"]: e for e in reversed(extras)}
+
+
+def upsert_package_extras(extras, values):
+    """
+    Like upsert_package_extra, for every key and value in the dictionary values.
+    Returns the updated package['extras'].
+    """
+    index = extras_index(extras)
+    for key, val in values.items():
+        if key in index:
+            index[key]["value"] = val
+        else:
+            index[key] = package_extra(key, val)
+            extras.append(index[key])
     return extras
 
 
+def save_harvest_objects(harvest_objects, batch_size=500):
+    """
+    Save a list of HarvestObjects in batches of batch_size, with one commit
+    per batch rather than committing each one separately with
+    HarvestObject.save().
+    Returns the ids of the saved objects.
+    """
+    object_ids = []
+    for start in range(0, len(harvest_objects), batch_size):
+        batch = harvest_objects[start : start + batch_size]
+        model.Session.add_all(batch)
+        # Flush first so the ids are populated, and read them before committing
+        # so SQLAlchemy doesn't reload every object to get its id.
+        model.Session.flush()
+        object_ids.extend(obj.id for obj in batch)
+        model.Session.commit()
+    return object_ids
+
+
 def harvester_search_dict(source_id, page, limit):
     return {
         "fq": '+harvest_source_id:"{0}"'.format(source_id),
@@ -108,20 +202,64 @@ def harvester_search_dict(source_id, page, limit):
 
 def get_harvested_dataset_ids(harvest_source_id):
     context = {"model": model, "session": model.Session}
+    package_search = toolkit.get_action("package_search")
     page = 1
     limit = 1000
-    query_result = toolkit.get_action("package_search")(
+    query_result = package_search(
         context,
         harvester_search_dict(harvest_source_id, page, limit),
     )
-    datasets = query_result["results"]
-    while len(datasets) < query_result["count"]:
+    # Only the ids are kept, rather than every page of results
+    dataset_ids = {d["id"] for d in query_result["results"]}
+    fetched = len(query_result["results"])
+    while fetched < query_result["count"]:
         page += 1
-        datasets += toolkit.get_action("package_search")(
+        results = package_search(
             context, harvester_search_dict(harvest_source_id, page, limit)
         )["results"]
+        if not results:
+            break
+        dataset_ids.update(d["id"] for d in results)
+        fetched += len(results)
+
+    return dataset_ids
+
+
+def get_ids_to_delete(harvest_source_id, fetched_ids):
+    """
+    Return the Set of ids of active datasets harvested by this harvest source
+    that aren't in fetched_ids, i.e. those that need to be deleted locally.
+
+    The comparison is done by the database, so only the ids of the datasets
+    to delete are loaded, rather than every dataset the source has harvested.
+    """
+    query = (
+        model.Session.query(HarvestObject.package_id)
+        .join(model.Package, model.Package.id == HarvestObject.package_id)
+        .filter(HarvestObject.harvest_source_id == harvest_source_id)
+        .filter(HarvestObject.current == True)  # noqa: E712
+        .filter(model.Package.state == "active")
+    )
+    if fetched_ids:
+        query = query.filter(HarvestObject.package_id.notin_(list(fetched_ids)))
+    return {package_id for (package_id,) in query.distinct()}
+
 
-    return {d["id"] for d in datasets}
+# These extras keys *should* be updated on every run of the harvester,
+# so they aren't transferred from an existing package
+REFRESHED_EXTRAS = frozenset(
+    (
+        "upstream_metadata_created",
+        "upstream_metadata_modified",
+        "upstream_url",
+        "harvest_object_id",
+        "harvest_source_id",
+        "harvest_source_title",
+        "london_smallest_geography",
+        "update_frequency",
+        "notes_with_markup",
+    )
+)
 
 
 def add_existing_extras(pkg_dict, context):
@@ -132,27 +270,16 @@ def add_existing_extras(pkg_dict, context):
             {"id": pkg_dict["id"], "use_default_schema": True},
         )
 
-        # These extras keys *should* be updated on every run of the harvester
-        remove_from_extras = [
-            "upstream_metadata_created",
-            "upstream_metadata_modified",
-            "upstream_url",
-            "harvest_object_id",
-            "harvest_source_id",
-            "harvest_source_title",
-            "london_smallest_geography",
-            "update_frequency",
-            "notes_with_markup",
-        ]
         extras_to_transfer = remove_extras(
-            existing_package["extras"], remove_from_extras
+            existing_package["extras"], REFRESHED_EXTRAS
         )
     except Exception as e:
         # If the package doesn't exist, there aren't any extras to transfer
         extras_to_transfer = []
 
-    for e in extras_to_transfer:
-        upsert_package_extra(pkg_dict["extras"], e["key"], e["value"])
+    upsert_package_extras(
+        pkg_dict["extras"], {e["key"]: e["value"] for e in extras_to_transfer}
+    )
 
     return extras_to_transfer
 
@@ -176,11 +303,23 @@ def add_default_keys(pkg_dict):
     return
 
 
-def add_default_extras(pkg_dict):
-    # Add an empty data_quality field to extras if it's not already there
-    if get_package_extra_val(pkg_dict["extras"], "data_quality") is None:
-        pkg_dict["extras"].append({"key": "data_quality", "value": ""})
+# Extras every harvested dataset should have, and the values to give them
+# if they're not already set
+DEFAULT_EXTRAS = (
+    # An empty data_quality field
+    ("data_quality", ""),
+    # A neutral dataset_boost field
+    ("dataset_boost", 1.0),
+)
+
 
-    # Add an empty dataset_boost field to extras if it's not already there
-    if get_package_extra_val(pkg_dict["extras"], "dataset_boost") is None:
-        pkg_dict["extras"].append({"key": "dataset_boost", "value": 1.0})
+def add_default_extras(pkg_dict):
+    # Add each of the DEFAULT_EXTRAS that isn't already there, checking the
+    # existing extras in one pass rather than once per default
+    extras = pkg_dict["extras"]
+    present = {e["key"] for e in extras if e["value"] is not None}
+    extras.extend(
+        package_extra(key, value)
+        for key, value in DEFAULT_EXTRAS
+        if key not in present
+    )